@@ -14,48 +14,178 @@
 
 
 import boto3
+import boto3.s3.transfer
+import botocore.config
+import collections
+import concurrent.futures
+import contextlib
+import importlib.machinery
+import importlib.util
 import json
 import os
 import re
-from subprocess import call, check_output, STDOUT
+import shutil
+import signal
+import tarfile
+import threading
+from subprocess import call, Popen, PIPE, STDOUT
+import time
 import traceback
 
 print('Loading function')
 
-udocker_bin = "/tmp/udocker/udocker"
-lambda_output = "/tmp/lambda-stdout.txt"
-script = "/tmp/udocker/script.sh"
+udocker_path = "/var/task/udocker"
+# Each request writes its script in its own directory
+script_path = "/tmp/%s/script.sh"
 container_name = 'lambda_cont'
 init_script_path = "/tmp/udocker/init_script.sh"
+warm_marker_path = "/tmp/udocker/.scar-warm"
+# Objects bigger than this are fetched as concurrent byte-range GETs
+s3_multipart_threshold = 16 * 1024 * 1024
+s3_multipart_chunksize = 8 * 1024 * 1024
+# Default size of the container output returned in the response (the
+# synchronous Lambda payload is limited to 6 MB)
+default_max_output_size = 512 * 1024
+# Maximum size of a single line read from the container output
+output_line_size = 64 * 1024
+# Size of the chunks written to the streamed inputs
+input_chunk_size = 1024 * 1024
+# Default seconds left to the function timeout when the container is stopped,
+# to upload the partial outputs
+default_timeout_threshold = 10
+# Fraction of the remaining time kept when it is below the threshold
+default_timeout_margin = 0.1
+# Seconds between asking the container to stop and killing it
+container_stop_grace = 2
+# Default number of times that a stopped execution is continued
+default_max_continuations = 5
+# Default space of the 512 MB of /tmp that can be used before evicting files
+default_tmp_space_limit = 400 * 1024 * 1024
+
+# Image of the prepared container, kept between invocations of the same sandbox
+warm_container_image = None
+# Lambda client used to continue the executions, kept between invocations
+lambda_client = None
+# udocker loaded in this process, kept between invocations of the same sandbox
+udocker_api = None
+# Metrics of the current invocation
+metrics = None
+
+def is_warm_container(container_image):
+    # The global only survives if the sandbox is reused, and the marker only
+    # survives if /tmp was not wiped, so both have to agree
+    if warm_container_image != container_image or not os.path.isfile(warm_marker_path):
+        return False
+    with open(warm_marker_path) as f:
+        return f.read() == container_image
+
+def set_warm_container(container_image):
+    global warm_container_image
+    create_file(container_image, warm_marker_path)
+    warm_container_image = container_image
 
 def prepare_environment(aws_request_id):
-    # Install udocker in /tmp
+    os.makedirs("/tmp/%s/output" % aws_request_id, exist_ok=True)
+    if is_warm_container(os.environ['IMAGE_ID']):
+        return
+    with metrics.phase("PrepareEnvironment"):
+        install_udocker()
+
+def install_udocker():
     os.makedirs("/tmp/udocker", exist_ok=True)    
-    call(["cp", "/var/task/udocker", udocker_bin])
-    call(["chmod", "u+rx", udocker_bin])
     os.makedirs("/tmp/home/.udocker", exist_ok=True)    
-    os.makedirs("/tmp/%s/output" % aws_request_id, exist_ok=True)  
     if ('INIT_SCRIPT_PATH' in os.environ) and os.environ['INIT_SCRIPT_PATH']:
         call(["cp", "/var/task/init_script.sh", init_script_path])
+    # The repository in /tmp may have been wiped since the last invocation
+    get_udocker().refresh()
+
+def get_udocker():
+    """The udocker API, loaded as a module once per sandbox instead of starting
+    a udocker process for each step. Only the container runs in a new process."""
+    global udocker_api
+    if udocker_api is None:
+        loader = importlib.machinery.SourceFileLoader("udocker", udocker_path)
+        module = importlib.util.module_from_spec(importlib.util.spec_from_loader("udocker", loader))
+        loader.exec_module(module)
+        udocker_api = module.UdockerAPI(verbose_level=module.Msg.MSG)
+    return udocker_api
 
 def prepare_container(container_image):
-    # Check if the container is already downloaded
-    cmd_out = check_output([udocker_bin, "images"]).decode("utf-8")
-    if container_image not in cmd_out:
-        print("SCAR: Pulling container '%s' from dockerhub" % container_image)
-        # If the container doesn't exist
-        call([udocker_bin, "pull", container_image])
+    if is_warm_container(container_image):
+        print("SCAR: Using warm container '%s'" % container_name)
+        return
+    if ('CONTAINER_ARCHIVE' in os.environ) and os.environ['CONTAINER_ARCHIVE']:
+        with metrics.phase("Restore"):
+            restore_container(os.environ['CONTAINER_ARCHIVE'])
     else:
-        print("SCAR: Container image '%s' already available" % container_image)
-    # Download and create container
-    cmd_out = check_output([udocker_bin, "ps"]).decode("utf-8")
-    if container_name not in cmd_out:
-        print("SCAR: Creating container with name '%s' based on image '%s'." % (container_name, container_image))
-        call([udocker_bin, "create", "--name=%s" % container_name, container_image])
-        # Set container execution engine to Fakechroot
-        call([udocker_bin, "setup", "--execmode=F1", container_name])
+        pull_and_create_container(container_image)
+    # A failed preparation must be retried by the next invocation
+    if not get_udocker().get_container_id(container_name):
+        raise Exception("Container '%s' is not available" % container_name)
+    set_warm_container(container_image)
+
+def restore_container(container_archive):
+    containers_dir = "%s/containers" % os.environ['UDOCKER_DIR']
+    if os.path.isdir("%s/%s" % (containers_dir, container_name)):
+        print("SCAR: Container '" + container_name + "' already available")
+        return
+    print("SCAR: Restoring container '%s' from '%s'" % (container_name, container_archive))
+    # The archive is extracted while it is read, without staging it in /tmp
+    if container_archive.startswith("s3://"):
+        bucket_name, file_key = container_archive[len("s3://"):].split("/", 1)
+        body = S3_Bucket().get_s3_client().get_object(Bucket=bucket_name, Key=file_key)['Body']
+        with tarfile.open(fileobj=body, mode="r|gz") as tar:
+            tar.extractall(os.environ['UDOCKER_DIR'], members=get_archive_members(tar))
     else:
+        with tarfile.open(container_archive, mode="r|gz") as tar:
+            tar.extractall(os.environ['UDOCKER_DIR'], members=get_archive_members(tar))
+    # The repository index does not know the extracted container
+    get_udocker().refresh(rescan=True)
+
+def get_archive_members(tar):
+    """Members of the container archive, which must be extracted inside the udocker directory."""
+    links = set()
+    for member in tar:
+        names = [member.name]
+        if member.islnk():
+            names.append(member.linkname)
+        for name in names:
+            path = os.path.normpath(name)
+            if os.path.isabs(path) or path == ".." or path.startswith("../"):
+                raise Exception("Invalid path '%s' in the container archive" % name)
+        # Paths of or through an extracted link, which would be written through
+        paths = [(member.name, os.path.normpath(member.name))]
+        if member.islnk():
+            paths.append((member.linkname, os.path.dirname(os.path.normpath(member.linkname))))
+        for name, path in paths:
+            while path:
+                if path in links:
+                    raise Exception("Invalid path '%s' in the container archive" % name)
+                path = os.path.dirname(path)
+        if member.issym() or member.islnk():
+            links.add(os.path.normpath(member.name))
+        yield member
+
+def pull_and_create_container(container_image):
+    udocker = get_udocker()
+    if udocker.get_container_id(container_name):
         print("SCAR: Container '" + container_name + "' already available")
+        return
+    if not udocker.has_image(container_image):
+        # Extract the image layers while they are downloaded
+        print("SCAR: Pulling image '%s' from dockerhub and creating container with name '%s'" % (container_image, container_name))
+        with metrics.phase("Pull"):
+            if not udocker.pull(container_image, name=container_name, create=True):
+                raise Exception("udocker could not pull the image '%s'" % container_image)
+    else:
+        print("SCAR: Creating container with name '%s' based on image '%s'." % (container_name, container_image))
+        with metrics.phase("Create"):
+            if not udocker.create(container_image, name=container_name):
+                raise Exception("udocker could not create the container '%s'" % container_name)
+    # Set container execution engine to Fakechroot
+    with metrics.phase("Setup"):
+        if not udocker.setup(container_name, "F1"):
+            raise Exception("udocker could not set up the container '%s'" % container_name)
 
 def check_alpine_image():
     home = os.environ['UDOCKER_DIR']
@@ -88,6 +218,87 @@ def get_global_variables():
     variables = add_global_variable(variables, "AWS_SECURITY_TOKEN", os.environ["AWS_SECURITY_TOKEN"])
     return variables
 
+def get_max_workers():
+    # Lambda allocates CPU and network bandwidth proportionally to the memory
+    memory = int(os.environ.get('AWS_LAMBDA_FUNCTION_MEMORY_SIZE', 128))
+    return max(2, min(memory // 128, 16))
+
+def get_max_connections():
+    # Each record processed concurrently transfers its files with its own workers
+    if ('RECORDS_MODE' in os.environ) and os.environ['RECORDS_MODE'] == "concurrent":
+        return get_max_workers() * get_max_records()
+    return get_max_workers()
+
+def get_max_records():
+    # Each container run gets at least 512 MB, and two runs per vCPU
+    # can overlap their S3 transfers with the computation of the other
+    memory = int(os.environ.get('AWS_LAMBDA_FUNCTION_MEMORY_SIZE', 128))
+    return max(1, min(2 * (os.cpu_count() or 1), memory // 512))
+
+def is_records_mode(event):
+    # Process each record of the event with its own container run
+    return (('RECORDS_MODE' in os.environ) and os.environ['RECORDS_MODE'] == "concurrent"
+            and Utils().is_s3_event(event) and len(event['Records']) > 1)
+
+def is_input_streamed():
+    # Feed the inputs to the container while they are downloaded
+    return ('INPUT_MODE' in os.environ) and os.environ['INPUT_MODE'] in ("fifo", "stdin")
+
+def get_input_streamer(event, request_id):
+    if is_input_streamed() and Utils().is_s3_event(event):
+        return InputStreamer(Utils().get_s3_records(event), request_id, os.environ['INPUT_MODE'])
+    return None
+
+def get_container_timeout(context):
+    """Seconds that the container can run before it must be stopped, 0 if
+    there is no time left to run it and None without a deadline."""
+    if not hasattr(context, 'get_remaining_time_in_millis'):
+        return None
+    threshold = default_timeout_threshold
+    if ('TIMEOUT_THRESHOLD' in os.environ) and os.environ['TIMEOUT_THRESHOLD']:
+        threshold = int(os.environ['TIMEOUT_THRESHOLD'])
+    remaining = context.get_remaining_time_in_millis() / 1000
+    if remaining <= 0:
+        return 0
+    if remaining <= threshold:
+        # Short functions keep a margin proportional to their time for the upload
+        upload_time = remaining * default_timeout_margin
+    else:
+        upload_time = threshold
+    # The container may take the whole grace period to stop
+    return max(0, remaining - upload_time - container_stop_grace)
+
+def get_lambda_client():
+    global lambda_client
+    if lambda_client is None:
+        lambda_client = boto3.client('lambda')
+    return lambda_client
+
+def continue_execution(event, context):
+    """Invoke the function asynchronously to continue a stopped execution."""
+    continuation = event.get('continuation', {'request_id' : context.aws_request_id, 'token' : 0})
+    max_continuations = default_max_continuations
+    if ('MAX_CONTINUATIONS' in os.environ) and os.environ['MAX_CONTINUATIONS']:
+        max_continuations = int(os.environ['MAX_CONTINUATIONS'])
+    if continuation['token'] >= max_continuations:
+        return "SCAR: Maximum number of continuations reached\n"
+    continuation_event = dict(event, continuation={'request_id' : continuation['request_id'],
+                                                   'token' : continuation['token'] + 1})
+    get_lambda_client().invoke(FunctionName=context.invoked_function_arn,
+                               InvocationType='Event',
+                               Payload=json.dumps(continuation_event))
+    return "SCAR: Execution continued with token %d\n" % continuation_event['continuation']['token']
+
+def get_tmp_space_limit():
+    if ('TMP_SPACE_LIMIT' in os.environ) and os.environ['TMP_SPACE_LIMIT']:
+        return int(os.environ['TMP_SPACE_LIMIT'])
+    return default_tmp_space_limit
+
+def get_max_output_size():
+    if ('MAX_OUTPUT_SIZE' in os.environ) and os.environ['MAX_OUTPUT_SIZE']:
+        return int(os.environ['MAX_OUTPUT_SIZE'])
+    return default_max_output_size
+
 def prepare_output(context):
     stdout = "SCAR: Log group name: %s\n" % context.log_group_name
     stdout += "SCAR: Log stream name: %s\n" % context.log_stream_name
@@ -107,46 +318,95 @@ def pre_process(event, context):
     create_event_file(json.dumps(event), context.aws_request_id)
     prepare_environment(context.aws_request_id)
     prepare_container(os.environ['IMAGE_ID'])
-    check_event_records(event, context)
+    TmpSpaceManager(context.aws_request_id, os.environ['IMAGE_ID']).free_space(get_tmp_space_limit())
+    if not is_records_mode(event):
+        check_event_records(event, context)
 
 def check_event_records(event, context):
     request_id = context.aws_request_id
-    if(Utils().is_s3_event(event)):
+    if(Utils().is_s3_event(event)) and not is_input_streamed():
         s3_records = Utils().get_s3_records(event)
-        for s3_record in s3_records:
-            S3_Bucket().download_input(s3_record, request_id)
+        with metrics.phase("Download"):
+            metrics.add_bytes("Download", S3_Bucket().download_inputs(s3_records, request_id))
 
 def post_process(event, context):
     request_id = context.aws_request_id
     if(Utils().is_s3_event(event)):
-        S3_Bucket().upload_output(event['Records'][0]['s3'], request_id)
+        with metrics.phase("Upload"):
+            metrics.add_bytes("Upload", S3_Bucket().upload_outputs(Utils().get_s3_records(event), request_id))
         call(["rm", "-rf", "/tmp/%s/output/" % request_id])
                 
-def create_command(event, context):
-    # Create container execution command
-    command = [udocker_bin, "--quiet", "run"]
+def process_records(event, context):
+    records = event['Records']
+    request_ids = ["%s-%d" % (context.aws_request_id, index) for index in range(len(records))]
+    max_output_size = max(1, get_max_output_size() // len(records))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=get_max_records()) as executor:
+        # Each record runs with the rest of the event, such as the script or the cmd_args
+        record_events = [dict(event, Records=[record]) for record in records]
+        outputs = executor.map(lambda args: process_record(*args, max_output_size=max_output_size,
+                                                           context=context),
+                               zip(record_events, request_ids))
+        return "".join(outputs)
+
+def process_record(record_event, request_id, max_output_size, context):
+    """Run the container for the event of a single record, in its own request directory."""
+    s3_records = Utils().get_s3_records(record_event)
+    stdout = "SCAR: Record %s with key %s (Request Id: %s)\n" % (
+        S3_Bucket().get_bucket_name(s3_records[0]), s3_records[0]['object']['key'], request_id)
+    try:
+        create_event_file(json.dumps(record_event), request_id)
+        os.makedirs("/tmp/%s/output" % request_id, exist_ok=True)
+        input_streamer = get_input_streamer(record_event, request_id)
+        if not input_streamer:
+            with metrics.phase("Download"):
+                metrics.add_bytes("Download", S3_Bucket().download_inputs(s3_records, request_id))
+        command = create_command(record_event, request_id)
+        print ("Udocker command: %s" % command)
+        watchdog = ContainerWatchdog(get_container_timeout(context))
+        with metrics.phase("Run"):
+            stdout += run_container(command, max_output_size, "[%s] " % request_id, input_streamer, watchdog)
+        with metrics.phase("Upload"):
+            metrics.add_bytes("Upload", S3_Bucket().upload_outputs(s3_records, request_id))
+        call(["rm", "-rf", "/tmp/%s/output/" % request_id])
+    except Exception:
+        error = "ERROR: Exception launched:\n %s" % traceback.format_exc()
+        print(error)
+        stdout += error
+    return stdout
+
+def create_command(event, request_id):
+    # Create the arguments of the udocker run command
+    command = []
     container_dirs = ["-v", "/tmp", "-v", "/dev", "-v", "/proc", "-v", "/etc/hosts", "--nosysdirs"]
-    container_vars = ["--env", "REQUEST_ID=%s" % context.aws_request_id]
+    container_vars = ["--env", "REQUEST_ID=%s" % request_id]
     command.extend(container_dirs)
     command.extend(container_vars)
+    # Let the container resume the work of a stopped execution
+    if ('continuation' in event) and event['continuation']:
+        command.extend(["--env", "CONTINUATION_REQUEST_ID=%s" % event['continuation']['request_id'],
+                        "--env", "CONTINUATION_TOKEN=%d" % event['continuation']['token']])
     
     # Add global variables (if any)
     global_variables = get_global_variables()
     if global_variables:
         command.extend(global_variables)
+    # Variables of this invocation, they take precedence over the global ones
+    if ('env' in event) and event['env']:
+        for key, value in sorted(event['env'].items()):
+            command.extend(["--env", "%s=%s" % (key, value)])
 
     # Use the correct script executable 
     script_exec = check_alpine_image()
 
     # Container running script
     if ('script' in event) and event['script']:
+        script = script_path % request_id
         create_file(event['script'], script)
         command.extend(["--entrypoint=%s %s" % (script_exec, script), container_name])
     # Container with args
     elif ('cmd_args' in event) and event['cmd_args']:
-        args = map(lambda x: x.encode('ascii'), event['cmd_args'])
         command.append(container_name)
-        command.extend(args)
+        command.extend(event['cmd_args'])
     # Script to be executed every time (if defined)
     elif ('INIT_SCRIPT_PATH' in os.environ) and os.environ['INIT_SCRIPT_PATH']:
         command.extend(["--entrypoint=%s %s" % (script_exec, init_script_path), container_name])
@@ -156,25 +416,415 @@ def create_command(event, context):
     return command
     
 def lambda_handler(event, context):
+    global metrics
     print("SCAR: Received event: " + json.dumps(event))
+    # A missing IMAGE_ID is reported by pre_process as any other error
+    metrics = Metrics(not is_warm_container(os.environ.get('IMAGE_ID')))
     stdout = prepare_output(context)
     try:
         pre_process(event, context)
-        # Create container execution command
-        command = create_command(event, context)
-        print ("Udocker command: %s" % command)
-        # Execute script
-        call(command, stderr=STDOUT, stdout=open(lambda_output, "w"))
-
-        stdout += check_output(["cat", lambda_output]).decode("utf-8")
-        
-        post_process(event, context)
+        if is_records_mode(event):
+            stdout += process_records(event, context)
+        else:
+            # Create container execution command
+            command = create_command(event, context.aws_request_id)
+            print ("Udocker command: %s" % command)
+            # Execute script
+            watchdog = ContainerWatchdog(get_container_timeout(context))
+            with metrics.phase("Run"):
+                stdout += run_container(command, input_streamer=get_input_streamer(event, context.aws_request_id),
+                                        watchdog=watchdog)
+            
+            post_process(event, context)
+            if watchdog.stopped and ('CONTINUATION' in os.environ) and os.environ['CONTINUATION'] == "true":
+                stdout += continue_execution(event, context)
         
     except Exception:
-        stdout += "ERROR: Exception launched:\n %s" % traceback.format_exc()
-    print(stdout)
+        error = "ERROR: Exception launched:\n %s" % traceback.format_exc()
+        print(error)
+        stdout += error
+    # Structured metrics line, collected from the logs by CloudWatch
+    metrics_line = json.dumps(metrics.get_embedded_metrics())
+    print(metrics_line)
+    stdout += "\nSCAR: Metrics: %s\n" % metrics_line
+    return stdout
+
+def run_container(command, max_output_size=None, log_prefix="", input_streamer=None, watchdog=None):
+    """Prepare the container with the udocker API of this process and execute it."""
+    stdout = get_udocker().run(command, lambda cmd, cwd, env: execute_command(
+        cmd, max_output_size, log_prefix, input_streamer, watchdog, cwd, env))
+    if stdout is None:
+        stdout = "ERROR: udocker could not run the container\n"
+        print(stdout, end='')
+    return stdout
+
+def execute_command(command, max_output_size=None, log_prefix="", input_streamer=None, watchdog=None,
+                    cwd=None, env=None):
+    if watchdog and watchdog.is_expired():
+        # The container could not be stopped before the function timeout
+        watchdog.stopped = True
+        return "SCAR: Not enough time left to run the container before the function timeout\n"
+    # Log the container output as it arrives and keep only its tail
+    output = OutputBuffer(max_output_size if max_output_size else get_max_output_size())
+    if input_streamer:
+        input_streamer.prepare()
+    stdin = PIPE if input_streamer and input_streamer.mode == "stdin" else None
+    # The container runs in its own process group to be able to stop all its processes
+    process = Popen(command, stdin=stdin, stdout=PIPE, stderr=STDOUT, start_new_session=True, cwd=cwd, env=env)
+    if input_streamer:
+        input_streamer.start(process)
+    if watchdog:
+        watchdog.start(process)
+    for line in iter(lambda: process.stdout.readline(output_line_size), b''):
+        print(log_prefix + line.decode("utf-8", errors="replace"), end='', flush=True)
+        output.append(line)
+    process.stdout.close()
+    process.wait()
+    if watchdog:
+        watchdog.cancel()
+    if input_streamer:
+        metrics.add_bytes("Download", input_streamer.finish())
+    stdout = output.getvalue()
+    if watchdog and watchdog.stopped:
+        stdout += "SCAR: Container stopped before the function timeout, the output is truncated\n"
     return stdout
 
+class ContainerWatchdog():
+    """Stops the container when its time is over, first asking it to terminate
+    and then killing it, so that the function does not time out."""
+
+    def __init__(self, timeout):
+        self.timeout = timeout
+        self.timer = None
+        self.stopped = False
+
+    def is_expired(self):
+        return self.timeout is not None and self.timeout <= 0
+
+    def start(self, process):
+        if self.timeout is None:
+            return
+        self.timer = threading.Timer(self.timeout, self.stop, [process])
+        self.timer.daemon = True
+        self.timer.start()
+
+    def cancel(self):
+        if self.timer:
+            self.timer.cancel()
+
+    def stop(self, process):
+        if process.poll() is not None:
+            return
+        print("SCAR: Stopping the container before the function timeout")
+        self.stopped = True
+        self.signal(process, signal.SIGTERM)
+        deadline = time.time() + container_stop_grace
+        while process.poll() is None and time.time() < deadline:
+            time.sleep(0.1)
+        if process.poll() is None:
+            self.signal(process, signal.SIGKILL)
+
+    def signal(self, process, signum):
+        try:
+            os.killpg(process.pid, signum)
+        except ProcessLookupError:
+            pass
+
+class InputStreamer():
+    """Feeds the S3 inputs to the container while they are downloaded, either
+    through named pipes created in place of the input files ('fifo' mode) or
+    through the standard input of the container ('stdin' mode)."""
+
+    def __init__(self, s3_records, request_id, mode):
+        self.s3_records = s3_records
+        self.request_id = request_id
+        self.mode = mode
+        self.fifo_paths = []
+        self.threads = []
+        self.size = 0
+        self.error = None
+        self.finished = False
+        self.lock = threading.Lock()
+
+    def get_input_path(self, s3_record):
+        return '/tmp/%s/%s' % (self.request_id, s3_record['object']['key'])
+
+    def prepare(self):
+        # The named pipes must exist before the container starts
+        if self.mode == "fifo":
+            for s3_record in self.s3_records:
+                fifo_path = self.get_input_path(s3_record)
+                os.makedirs(os.path.dirname(fifo_path), exist_ok=True)
+                os.mkfifo(fifo_path)
+                self.fifo_paths.append(fifo_path)
+
+    def start(self, process):
+        if self.mode == "fifo":
+            for s3_record, fifo_path in zip(self.s3_records, self.fifo_paths):
+                self.start_thread(self.feed_fifo, s3_record, fifo_path)
+        else:
+            self.start_thread(self.feed_stdin, process.stdin)
+
+    def start_thread(self, target, *args):
+        thread = threading.Thread(target=target, args=args, daemon=True)
+        thread.start()
+        self.threads.append(thread)
+
+    def copy_object(self, s3_record, output):
+        bucket_name = S3_Bucket().get_bucket_name(s3_record)
+        file_key = s3_record['object']['key']
+        print ("Streaming item from bucket %s with key %s" % (bucket_name, file_key))
+        body = S3_Bucket().get_s3_client().get_object(Bucket=bucket_name, Key=file_key)['Body']
+        try:
+            for chunk in iter(lambda: body.read(input_chunk_size), b''):
+                output.write(chunk)
+                with self.lock:
+                    self.size += len(chunk)
+        finally:
+            body.close()
+
+    def feed_fifo(self, s3_record, fifo_path):
+        try:
+            # Blocks until the container opens the file
+            with open(fifo_path, "wb") as fifo:
+                if not self.finished:
+                    self.copy_object(s3_record, fifo)
+        except BrokenPipeError:
+            # The container closed the file before reading all of it
+            pass
+        except Exception as e:
+            self.error = e
+
+    def feed_stdin(self, stdin):
+        try:
+            for s3_record in self.s3_records:
+                self.copy_object(s3_record, stdin)
+            stdin.close()
+        except BrokenPipeError:
+            pass
+        except Exception as e:
+            self.error = e
+
+    def finish(self):
+        """Release the feeders still waiting for the container and return the bytes streamed."""
+        self.finished = True
+        if self.mode == "fifo":
+            for thread, fifo_path in zip(self.threads, self.fifo_paths):
+                while thread.is_alive():
+                    # Opening the read end unblocks a writer whose file was never opened
+                    os.close(os.open(fifo_path, os.O_RDONLY | os.O_NONBLOCK))
+                    thread.join(0.1)
+        for thread in self.threads:
+            thread.join()
+        for fifo_path in self.fifo_paths:
+            os.remove(fifo_path)
+        if self.error:
+            raise self.error
+        return self.size
+
+class TmpSpaceManager():
+    """Keeps the space used in /tmp under a limit by removing the least recently
+    used request directories, udocker images, extracted image trees and containers.
+    The current request directory, the image of the function and its container
+    are never removed."""
+
+    def __init__(self, request_id, container_image, tmp_dir="/tmp", udocker_dir=None):
+        self.tmp_dir = tmp_dir
+        self.udocker_dir = udocker_dir if udocker_dir else os.environ['UDOCKER_DIR']
+        self.request_dir = os.path.join(tmp_dir, request_id)
+        self.image_dir = self.get_image_dir(container_image)
+        self.container_dir = os.path.realpath(os.path.join(self.udocker_dir, "containers", container_name))
+
+    def get_image_dir(self, container_image):
+        # Same naming that udocker uses for the image repositories
+        if ":" in container_image.split("/")[-1]:
+            image_repo, tag = container_image.rsplit(":", 1)
+        else:
+            image_repo, tag = container_image, "latest"
+        if image_repo.startswith("library/"):
+            image_repo = image_repo[len("library/"):]
+        return os.path.join(self.udocker_dir, "repos", image_repo, tag)
+
+    def get_used_space(self):
+        return shutil.disk_usage(self.tmp_dir).used
+
+    def get_size(self, paths):
+        """Bytes freed by removing the paths. A hard linked file is counted
+        once, and only if all its links are removed."""
+        size = 0
+        links = {}
+        for path in paths:
+            names = [path]
+            if os.path.isdir(path) and not os.path.islink(path):
+                for dirname, dirnames, filenames in os.walk(path):
+                    names.extend(os.path.join(dirname, name) for name in dirnames + filenames)
+            for name in names:
+                stat = os.lstat(name)
+                if stat.st_nlink > 1 and not os.path.isdir(name):
+                    # Container files can be hard linked to the extracted image trees
+                    key = (stat.st_dev, stat.st_ino)
+                    links[key] = (links.get(key, (0,))[0] + 1, stat.st_nlink, stat.st_size)
+                else:
+                    size += stat.st_size
+        return size + sum(file_size for count, nlink, file_size in links.values() if count >= nlink)
+
+    def get_last_used(self, path):
+        stat = os.lstat(path)
+        return max(stat.st_atime, stat.st_mtime)
+
+    def get_request_dirs(self):
+        dirs = []
+        for name in os.listdir(self.tmp_dir):
+            path = os.path.join(self.tmp_dir, name)
+            # Request directories always contain the event file
+            if path != self.request_dir and os.path.isfile(os.path.join(path, "event.json")):
+                dirs.append([path])
+        return dirs
+
+    def get_images(self):
+        repos_dir = os.path.join(self.udocker_dir, "repos")
+        tag_layers = {}
+        for dirname, dirnames, filenames in os.walk(repos_dir):
+            if "TAG" in filenames:
+                tag_layers[dirname] = [os.path.realpath(os.path.join(dirname, name))
+                                       for name in filenames if os.path.islink(os.path.join(dirname, name))]
+        images = []
+        for tag_dir, layers in tag_layers.items():
+            if tag_dir == self.image_dir:
+                continue
+            # Layers shared with other images are kept
+            shared_layers = [layer for other_dir, other_layers in tag_layers.items()
+                             if other_dir != tag_dir for layer in other_layers]
+            images.append([tag_dir] + [layer for layer in layers
+                                       if layer not in shared_layers and os.path.exists(layer)])
+        return images
+
+    def get_trees(self):
+        trees_dir = os.path.join(self.udocker_dir, "trees")
+        if not os.path.isdir(trees_dir):
+            return []
+        # The trees being extracted are renamed from a .tmp directory when done
+        return [[os.path.join(trees_dir, name)] for name in os.listdir(trees_dir)
+                if not name.endswith(".tmp")]
+
+    def get_containers(self):
+        containers_dir = os.path.join(self.udocker_dir, "containers")
+        if not os.path.isdir(containers_dir):
+            return []
+        containers = []
+        for name in os.listdir(containers_dir):
+            path = os.path.join(containers_dir, name)
+            if os.path.islink(path) or path == self.container_dir:
+                continue
+            # Remove the container name links too
+            links = [os.path.join(containers_dir, link) for link in os.listdir(containers_dir)
+                     if os.path.islink(os.path.join(containers_dir, link))
+                     and os.path.realpath(os.path.join(containers_dir, link)) == path]
+            containers.append([path] + links)
+        return containers
+
+    def remove(self, paths):
+        for path in paths:
+            print("SCAR: Freeing space in /tmp, removing '%s'" % path)
+            if os.path.isdir(path) and not os.path.islink(path):
+                # udocker leaves some read-only directories in the containers
+                call(["chmod", "-R", "u+w", path])
+            call(["rm", "-rf", path])
+
+    def free_space(self, limit):
+        used_space = self.get_used_space()
+        if used_space <= limit:
+            return
+        items = self.get_request_dirs() + self.get_images() + self.get_trees() + self.get_containers()
+        items.sort(key=lambda paths: self.get_last_used(paths[0]))
+        udocker_changed = False
+        for paths in items:
+            if used_space <= limit:
+                break
+            used_space -= self.get_size(paths)
+            self.remove(paths)
+            udocker_changed = udocker_changed or paths[0].startswith(self.udocker_dir + "/")
+        if udocker_changed:
+            # The repository index still has the removed images and containers
+            get_udocker().refresh(rescan=True)
+
+class Metrics():
+    """Time and bytes transferred by each phase of an invocation."""
+
+    namespace = "SCAR"
+
+    def __init__(self, cold):
+        self.cold = cold
+        self.times = collections.OrderedDict()
+        self.bytes = collections.OrderedDict()
+        # Records can be processed concurrently
+        self.lock = threading.Lock()
+        self.running = {}
+        self.started = {}
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        # Overlapping runs of a phase count their wall-clock time once
+        with self.lock:
+            if not self.running.get(name):
+                self.started[name] = time.time()
+            self.running[name] = self.running.get(name, 0) + 1
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.running[name] -= 1
+                if not self.running[name]:
+                    self.times[name] = self.times.get(name, 0) + int((time.time() - self.started[name]) * 1000)
+
+    def add_bytes(self, name, size):
+        with self.lock:
+            self.bytes[name] = self.bytes.get(name, 0) + size
+
+    def get_embedded_metrics(self):
+        # CloudWatch embedded metric format
+        values = collections.OrderedDict()
+        values["FunctionName"] = os.environ.get('AWS_LAMBDA_FUNCTION_NAME', "local")
+        values["ColdStart"] = self.cold
+        definitions = []
+        for name, value in self.times.items():
+            values[name + "Time"] = value
+            definitions.append({"Name" : name + "Time", "Unit" : "Milliseconds"})
+        for name, value in self.bytes.items():
+            values[name + "Bytes"] = value
+            definitions.append({"Name" : name + "Bytes", "Unit" : "Bytes"})
+        values["_aws"] = {"Timestamp" : int(time.time() * 1000),
+                          "CloudWatchMetrics" : [{"Namespace" : self.namespace,
+                                                  "Dimensions" : [["FunctionName"]],
+                                                  "Metrics" : definitions}]}
+        return values
+
+class OutputBuffer():
+    """Ring buffer that keeps the last lines of an output up to max_size bytes."""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.lines = collections.deque()
+        self.size = 0
+        self.truncated = False
+
+    def append(self, line):
+        # Keep the last bytes of lines longer than the buffer
+        if len(line) > self.max_size:
+            line = line[-self.max_size:]
+            self.truncated = True
+        self.lines.append(line)
+        self.size += len(line)
+        while self.size > self.max_size:
+            self.size -= len(self.lines.popleft())
+            self.truncated = True
+
+    def getvalue(self):
+        value = b"".join(self.lines).decode("utf-8", errors="replace")
+        if self.truncated:
+            value = "SCAR: Output truncated, showing the last %d bytes\n%s" % (self.size, value)
+        return value
+
 class Utils():
     def is_s3_event(self, event):
         if ('Records' in event) and event['Records']:
@@ -193,33 +843,77 @@ class Utils():
         return records
 
 class S3_Bucket():
-    
+
+    # Shared between invocations to reuse the connection pool
+    client = None
+
     def get_s3_client(self):
-        return boto3.client('s3')
+        if S3_Bucket.client is None:
+            config = botocore.config.Config(max_pool_connections=get_max_connections())
+            S3_Bucket.client = boto3.client('s3', config=config)
+        return S3_Bucket.client
+
+    def get_transfer_config(self, max_concurrency):
+        return boto3.s3.transfer.TransferConfig(multipart_threshold=s3_multipart_threshold,
+                                                multipart_chunksize=s3_multipart_chunksize,
+                                                max_concurrency=max_concurrency)
 
     def get_bucket_name(self, s3_record):
         return s3_record['bucket']['name']
     
-    def download_input(self, s3_record, request_id):
+    def download_input(self, s3_record, request_id, max_concurrency=1):
         bucket_name = self.get_bucket_name(s3_record)
         file_key = s3_record['object']['key']
         download_path = '/tmp/%s/%s' % (request_id, file_key)
         print ("Downloading item from bucket %s with key %s" % (bucket_name, file_key))
         os.makedirs(os.path.dirname(download_path), exist_ok=True)        
-        self.get_s3_client().download_file(bucket_name, file_key, download_path)
+        self.get_s3_client().download_file(bucket_name, file_key, download_path,
+                                           Config=self.get_transfer_config(max_concurrency))
+        return os.path.getsize(download_path)
 
-    def upload_output(self, s3_record, request_id):
-        bucket_name = self.get_bucket_name(s3_record)
+    def download_inputs(self, s3_records, request_id):
+        """Download the records inputs and return the number of bytes downloaded."""
+        if not s3_records:
+            return 0
+        max_workers = get_max_workers()
+        # Split the connections between the records so the pool is not exhausted
+        max_concurrency = max(1, max_workers // len(s3_records))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(max_workers, len(s3_records))) as executor:
+            futures = [executor.submit(self.download_input, s3_record, request_id, max_concurrency)
+                       for s3_record in s3_records]
+            # Raise any download error
+            return sum(future.result() for future in concurrent.futures.as_completed(futures))
+
+    def upload_output(self, bucket_name, file_key, file_path, max_concurrency=1):
+        print ("Uploading file to bucket %s with key %s" % (bucket_name, file_key))
+        # Set the ACL in the upload request to avoid an extra call per object
+        self.get_s3_client().upload_file(file_path, bucket_name, file_key,
+                                         ExtraArgs={'ACL' : 'public-read'},
+                                         Config=self.get_transfer_config(max_concurrency))
+
+    def upload_outputs(self, s3_records, request_id):
+        """Upload the output files to the records buckets and return the number of bytes uploaded."""
         output_folder = "/tmp/%s/output/" % request_id
         output_files_path = self.get_all_files_in_directory(output_folder)
-        for file_path in output_files_path:
-            file_key = "output/%s" % file_path.replace(output_folder, "")
-            print ("Uploading file to bucket %s with key %s" % (bucket_name, file_key))
-            self.get_s3_client().upload_file(file_path, bucket_name, file_key)
-            print ("Changing ACLs for public-read for object in bucket %s with key %s" % (bucket_name, file_key))
-            s3_resource = boto3.resource('s3')
-            obj = s3_resource.Object(bucket_name, file_key)
-            obj.Acl().put(ACL='public-read')
+        # Each originating bucket receives the output files once
+        bucket_names = []
+        for s3_record in s3_records:
+            bucket_name = self.get_bucket_name(s3_record)
+            if bucket_name not in bucket_names:
+                bucket_names.append(bucket_name)
+        uploads = [(bucket_name, "output/%s" % file_path.replace(output_folder, ""), file_path)
+                   for bucket_name in bucket_names for file_path in output_files_path]
+        if not uploads:
+            return 0
+        max_workers = get_max_workers()
+        max_concurrency = max(1, max_workers // len(uploads))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(max_workers, len(uploads))) as executor:
+            futures = [executor.submit(self.upload_output, bucket_name, file_key, file_path, max_concurrency)
+                       for bucket_name, file_key, file_path in uploads]
+            for future in concurrent.futures.as_completed(futures):
+                # Raise any upload error
+                future.result()
+        return sum(os.path.getsize(upload[2]) for upload in uploads)
 
     def get_all_files_in_directory(self, dir_path):
         files = []
@@ -17,18 +17,27 @@
 
 import argparse
 import base64
-import boto3
 import configparser
+import io
 import json
 import os
+import random
 import re
 import shutil
 import sys
+import tarfile
+import threading
+import time
 import uuid
 import zipfile
-from botocore.exceptions import ClientError
+from botocore.exceptions import BotoCoreError, ClientError
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, as_completed, wait
 from subprocess import call
-from tabulate import tabulate
+
+try:
+    string_types = basestring  # Python 2
+except NameError:
+    string_types = str
 
 class Scar(object):
     """Implements most of the command line interface.
@@ -51,14 +60,24 @@ class Scar(object):
             sys.exit(1)         
         aws_client = self.get_aws_client()
         # Check if function exists
-        aws_client.check_function_name_exists(Config.lambda_name, (True if args.verbose or args.json else False))       
+        aws_client.check_function_name_exists(Config.lambda_name, (True if args.verbose or args.json else False))
         # Set the rest of the parameters
         Config.lambda_handler = Config.lambda_name + ".lambda_handler"
+        # Build the container locally to avoid pulling it on every cold start
+        archive_path = None
+        if args.prebuild or args.prebuild_bucket:
+            archive_path = self.create_container_archive(args.image_id)
+            if args.prebuild_bucket:
+                Config.lambda_env_variables['Variables']['CONTAINER_ARCHIVE'] = \
+                    aws_client.upload_container_archive(args.prebuild_bucket, Config.lambda_name, archive_path)
+                archive_path = None
+            else:
+                Config.lambda_env_variables['Variables']['CONTAINER_ARCHIVE'] = "/var/task/" + Config.container_archive_name
         if args.script:
-            Config.lambda_zip_file = {"ZipFile": self.create_zip_file(Config.lambda_name, args.script)}
+            Config.lambda_zip_file = {"ZipFile": self.create_zip_file(Config.lambda_name, args.script, archive_path)}
             Config.lambda_env_variables['Variables']['INIT_SCRIPT_PATH'] = "/var/task/init_script.sh"
         else:
-            Config.lambda_zip_file = {"ZipFile": self.create_zip_file(Config.lambda_name)}
+            Config.lambda_zip_file = {"ZipFile": self.create_zip_file(Config.lambda_name, archive_path=archive_path)}
         if args.memory:
             Config.lambda_memory = self.check_memory(args.memory)
         if args.time:
@@ -67,6 +86,8 @@ class Scar(object):
             Config.lambda_description = args.description  
         if args.image_id:
             Config.lambda_env_variables['Variables']['IMAGE_ID'] = args.image_id
+        if args.layer_cache:
+            Config.lambda_env_variables['Variables']['UDOCKER_LAYER_CACHE'] = "s3://%s/layers" % args.layer_cache
         # Modify environment vars if necessary   
         if args.env:
             StringUtils().parse_environment_variables(args.env)            
@@ -89,6 +110,7 @@ class Scar(object):
                                                          Tags=Config.lambda_tags)
             # Parse results
             function_arn = lambda_response['FunctionArn']
+            FunctionCache().update([lambda_response])
             result.append_to_verbose('LambdaOutput', lambda_response)
             result.append_to_json('LambdaOutput', {'AccessKey' : aws_client.get_access_key(),
                                                    'FunctionArn' : lambda_response['FunctionArn'],
@@ -103,6 +125,8 @@ class Scar(object):
         finally:       
             # Remove the zip created in the operation   
             os.remove(Config.zif_file_path)
+            if os.path.isfile(Config.container_archive_path):
+                os.remove(Config.container_archive_path)
 
         # Create log group
         log_group_name = '/aws/lambda/' + Config.lambda_name
@@ -147,17 +171,29 @@ class Scar(object):
         result = Result()
         try:
             # Get the filtered resources from AWS
-            lambda_functions = aws_client.get_all_functions()
+            function_arns = aws_client.get_functions_arn_list()
+            # With stream the plain and JSON outputs are printed as the functions arrive
+            streamed = args.stream and not args.verbose
+            if streamed and not args.json:
+                result.print_table_header([StringUtils().get_function_name(arn) for arn in function_arns])
             # Create the data structure
             functions_parsed_info = []
             functions_full_info = []
-            for lambda_function in lambda_functions:
+            for lambda_function in aws_client.get_all_functions(function_arns):
                 parsed_function = {'Name' : lambda_function['Configuration']['FunctionName'],
                             'Memory' : lambda_function['Configuration']['MemorySize'],
                             'Timeout' : lambda_function['Configuration']['Timeout'],
                             'Image_id': lambda_function['Configuration']['Environment']['Variables']['IMAGE_ID']}
                 functions_full_info.append(lambda_function)
                 functions_parsed_info.append(parsed_function)
+                if streamed and args.json:
+                    result.print_json_line(parsed_function)
+                elif streamed:
+                    result.print_table_row(parsed_function)
+            # If every function was listed the cache is replaced, otherwise the
+            # functions whose request failed would be dropped from it
+            FunctionCache().update([function['Configuration'] for function in functions_full_info],
+                                   replace=len(functions_full_info) == len(function_arns))
             
             result.append_to_verbose('LambdaOutput', functions_full_info)
             result.append_to_json('Functions', functions_parsed_info)
@@ -165,9 +201,11 @@ class Scar(object):
             # Parse output
             if args.verbose:
                 result.print_verbose_result()
+            elif streamed:
+                pass
             elif args.json:
                 result.print_json_result()
-            else:  
+            else:
                 result.generate_table(functions_parsed_info)
                 
         except ClientError as ce:
@@ -175,6 +213,12 @@ class Scar(object):
 
         
     def run(self, args):
+        if args.batch:
+            if args.concurrency < 1:
+                print ("Error: The concurrency must be greater than 0.")
+                sys.exit(1)
+            # One connection for each invocation in flight
+            Config.boto_max_pool_connections = max(Config.boto_max_pool_connections, args.concurrency)
         aws_client = self.get_aws_client()
         # Check if function not exists
         aws_client.check_function_name_not_exists(args.name, (True if args.verbose or args.json else False))
@@ -193,6 +237,9 @@ class Scar(object):
         # Modify environment vars if necessary   
         if args.env:
             aws_client.update_function_env_variables(args.name, args.env)
+        if args.batch:
+            self.run_batch(args, aws_client, invocation_type)
+            return
             
         script = ""
         # Parse the function script
@@ -210,6 +257,9 @@ class Scar(object):
                                                   LogType=log_type,
                                                   Payload=script)
         except ClientError as ce:
+            if ce.response['Error']['Code'] == 'ResourceNotFoundException':
+                # Deleted out of scar while still in the local cache
+                FunctionCache().remove(args.name)
             print ("Error invoking lambda function: %s" % ce)
         
         # Decode and parse the payload
@@ -252,12 +302,76 @@ class Scar(object):
         # Show results
         result.print_results(json=args.json, verbose=args.verbose)                
         
+    def run_batch(self, args, aws_client, invocation_type):
+        """Invoke the function once for each payload line of args.batch with
+        up to args.concurrency invocations in flight. The results are printed
+        as JSON lines in completion order."""
+        throttle = InvocationThrottle(args.concurrency)
+        start = time.time()
+        errors = 0
+        count = 0
+        with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+            pending = set()
+            for line_number, line in enumerate(args.batch, 1):
+                if not line.strip():
+                    continue
+                # Don't read the whole input ahead, it may be an endless stream
+                if len(pending) >= 2 * args.concurrency:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    errors += self.print_batch_results(done)
+                pending.add(executor.submit(self.invoke_batch_line, aws_client, args.name, invocation_type,
+                                            throttle, line_number, line))
+                count += 1
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                errors += self.print_batch_results(done)
+        sys.stderr.write("SCAR: %d invocations, %d errors in %.2f seconds\n" % (count, errors, time.time() - start))
+        if errors:
+            sys.exit(1)
+
+    def print_batch_results(self, futures):
+        errors = 0
+        for future in futures:
+            result = future.result()
+            if 'Error' in result:
+                errors += 1
+            # Each result is shown as soon as it is known
+            sys.stdout.write(json.dumps(result) + '\n')
+            sys.stdout.flush()
+        return errors
+
+    def invoke_batch_line(self, aws_client, function_name, invocation_type, throttle, line_number, line):
+        result = {'Line' : line_number}
+        try:
+            payload = StringUtils().parse_batch_payload(line)
+            response, result['Retries'], result['Latency'] = aws_client.invoke_function(function_name,
+                                                                                        invocation_type,
+                                                                                        payload, throttle)
+            response = StringUtils().parse_payload(response)
+            result['StatusCode'] = response['StatusCode']
+            result['RequestId'] = response['ResponseMetadata']['RequestId']
+            result['Payload'] = response['Payload']
+            if "FunctionError" in response:
+                result['Error'] = response['FunctionError']
+        except ValueError as ve:
+            result['Error'] = "Invalid payload: %s" % ve
+        except (BotoCoreError, ClientError) as error:
+            result['Error'] = str(error)
+        except Exception as error:
+            # An unexpected error only fails its own line, not the whole batch
+            result['Error'] = "%s: %s" % (type(error).__name__, error)
+        return result
+
     def rm(self, args):
         aws_client = self.get_aws_client()
         if args.all:
-            lambda_functions = aws_client.get_all_functions()
-            for function in lambda_functions:
-                aws_client.delete_resources(function['Configuration']['FunctionName'], args.json, args.verbose)
+            function_names = [StringUtils().get_function_name(arn) for arn in aws_client.get_functions_arn_list()]
+            with ThreadPoolExecutor(max_workers=Config.aws_max_workers) as executor:
+                futures = [executor.submit(aws_client.delete_function_resources, function_name)
+                           for function_name in function_names]
+                # Show the results as each function is deleted
+                for future in as_completed(futures):
+                    future.result().print_results(args.json, args.verbose)
         else:
             aws_client.delete_resources(args.name, args.json, args.verbose)
         
@@ -279,7 +393,32 @@ class Scar(object):
             raise Exception('Incorrect time specified')
         return lambda_time
     
-    def create_zip_file(self, file_name, script_path=None):
+    def create_container_archive(self, image_id):
+        """ Pull, create and setup the container with the bundled udocker
+        and pack the resulting container tree in a compressed archive.
+        The container is built in the same UDOCKER_DIR used by the lambda
+        function because udocker stores absolute paths in the container."""
+        udocker_bin = Config.dir_path + '/lambda/udocker'
+        udocker_dir = Config.lambda_env_variables['Variables']['UDOCKER_DIR']
+        udocker_env = dict(os.environ, UDOCKER_DIR=udocker_dir,
+                           UDOCKER_TARBALL=Config.dir_path + '/lambda/udocker-1.1.0-RC2.tar.gz')
+        container_name = 'lambda_cont'
+        containers_dir = udocker_dir + '/containers'
+        if os.path.lexists(containers_dir + '/' + container_name):
+            call([udocker_bin, "rm", container_name], env=udocker_env)
+        for cmd in [["pull", image_id],
+                    ["create", "--name=%s" % container_name, image_id],
+                    ["setup", "--execmode=F1", container_name]]:
+            if call([udocker_bin] + cmd, env=udocker_env) != 0:
+                raise Exception("Error building the container: 'udocker %s' failed" % " ".join(cmd))
+        container_id = os.path.basename(os.path.realpath(containers_dir + '/' + container_name))
+        with tarfile.open(Config.container_archive_path, 'w:gz') as tar:
+            # The container name is a symbolic link to the container id directory
+            tar.add(containers_dir + '/' + container_name, arcname='containers/' + container_name)
+            tar.add(containers_dir + '/' + container_id, arcname='containers/' + container_id)
+        return Config.container_archive_path
+
+    def create_zip_file(self, file_name, script_path=None, archive_path=None):
         # Set generic lambda function name
         function_name = file_name + '.py'
         # Copy file to avoid messing with the repo files
@@ -296,6 +435,9 @@ class Scar(object):
             os.remove(function_name)
             if script_path:
                 zf.write(script_path, 'init_script.sh')
+            # Prebuilt container
+            if archive_path:
+                zf.write(archive_path, Config.container_archive_name)
         # Return the zip as an array of bytes
         with open(Config.zif_file_path, 'rb') as f:
             return f.read()
@@ -393,6 +535,27 @@ class StringUtils(object):
     def print_json(self, value):
         print(json.dumps(value))
 
+    def get_function_name(self, function_arn):
+        # arn:aws:lambda:<region>:<account>:function:<name>
+        return function_arn.split(':')[6]
+
+    def parse_batch_payload(self, line):
+        """Payload of a batch line, a JSON object with the 'script' to run,
+        the container 'cmd_args' and the 'env' variables of the invocation"""
+        payload = json.loads(line)
+        if not isinstance(payload, dict):
+            raise ValueError("a JSON object is expected")
+        unknown_keys = set(payload) - set(['script', 'cmd_args', 'env'])
+        if unknown_keys:
+            raise ValueError("unknown keys %s" % ", ".join(sorted(unknown_keys)))
+        if not isinstance(payload.get('script', ""), string_types):
+            raise ValueError("'script' must be a string")
+        if not isinstance(payload.get('cmd_args', []), list):
+            raise ValueError("'cmd_args' must be a list")
+        if not isinstance(payload.get('env', {}), dict):
+            raise ValueError("'env' must be an object")
+        return json.dumps(payload)
+
     def parse_environment_variables(self, env_vars):
         for var in env_vars:
             var_parsed = var.split("=")
@@ -418,6 +581,25 @@ class Config(object):
     dir_path = os.path.dirname(os.path.realpath(__file__))
         
     zif_file_path = dir_path + '/function.zip'        
+
+    container_archive_name = 'container.tar.gz'
+    container_archive_path = dir_path + '/' + container_archive_name
+
+    # Connections kept open to each AWS service endpoint
+    boto_max_pool_connections = 50
+
+    # Seconds the metadata of the functions is kept in the local cache
+    function_cache_ttl = 300
+
+    # Concurrent AWS requests of 'scar ls' and 'scar rm --all'
+    aws_max_workers = 10
+
+    # Invocations in flight of 'scar run --batch'
+    batch_concurrency = 100
+    # Throttled invocations are retried with exponential backoff (seconds)
+    batch_max_retries = 8
+    batch_backoff_base = 0.1
+    batch_backoff_max = 20
         
     config = configparser.ConfigParser()    
     
@@ -442,8 +624,12 @@ class Config(object):
             else:
                 self.create_config_file(scar_dir)
         else:
-            # Create scar dir
-            call(["mkdir", "-p", scar_dir])
+            # Create scar dir, another scar process may be creating it too
+            try:
+                os.makedirs(scar_dir)
+            except OSError:
+                if not os.path.isdir(scar_dir):
+                    raise
             self.create_config_file(scar_dir)
     
     def parse_config_file_values(self):
@@ -456,8 +642,116 @@ class Config(object):
         Config.lambda_memory = scar_config.getint('lambda_memory', fallback=Config.lambda_memory)
         Config.lambda_time = scar_config.getint('lambda_time', fallback=Config.lambda_time)
         Config.lambda_description = scar_config.get('lambda_description', fallback=Config.lambda_description)
+        Config.function_cache_ttl = scar_config.getint('function_cache_ttl', fallback=Config.function_cache_ttl)
+
+class FunctionCache(object):
+    """Metadata of the SCAR functions (ARN, memory, timeout and image id) kept
+    in ~/.scar/functions.json, so the commands don't ask AWS if a function exists
+    every time. Entries expire after Config.function_cache_ttl seconds and are
+    updated by init, rm and ls."""
+
+    lock = threading.Lock()
+
+    def __init__(self):
+        self.cache_file = os.path.expanduser("~") + "/.scar/functions.json"
+
+    def load(self):
+        try:
+            with open(self.cache_file) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def save(self, cache):
+        # Write and rename so concurrent scar processes never read half a file
+        tmp_file = "%s.%d.tmp" % (self.cache_file, os.getpid())
+        try:
+            with open(tmp_file, 'w') as f:
+                json.dump(cache, f)
+            # rename replaces the file atomically on POSIX, on python 2 too
+            os.rename(tmp_file, self.cache_file)
+        except (IOError, OSError):
+            pass
+
+    def parse_configuration(self, configuration):
+        variables = configuration.get('Environment', {}).get('Variables', {})
+        return {'Name' : configuration['FunctionName'],
+                'Arn' : configuration['FunctionArn'],
+                'Memory' : configuration['MemorySize'],
+                'Timeout' : configuration['Timeout'],
+                'Image_id' : variables.get('IMAGE_ID', ''),
+                'CacheTime' : time.time()}
+
+    def get(self, function_name, region=None):
+        if region is None:
+            region = Config.lambda_region
+        with FunctionCache.lock:
+            function = self.load().get(region, {}).get(function_name)
+        if function and (time.time() - function['CacheTime'] < Config.function_cache_ttl):
+            return function
+
+    def update(self, configurations, region=None, replace=False):
+        """Add the functions to the cache. With replace, the functions of the region
+        not in configurations are removed."""
+        if region is None:
+            region = Config.lambda_region
+        functions = [self.parse_configuration(configuration) for configuration in configurations]
+        with FunctionCache.lock:
+            cache = self.load()
+            region_cache = {} if replace else cache.get(region, {})
+            for function in functions:
+                region_cache[function['Name']] = function
+            cache[region] = region_cache
+            self.save(cache)
+        return functions
+
+    def remove(self, function_name, region=None):
+        if region is None:
+            region = Config.lambda_region
+        with FunctionCache.lock:
+            cache = self.load()
+            if function_name in cache.get(region, {}):
+                del cache[region][function_name]
+                self.save(cache)
         
+class InvocationThrottle(object):
+    """Limits the invocations in flight of a batch. Each throttled invocation
+    halves the limit and each successful one raises it by one, up to the
+    concurrency requested, so the batch settles at the rate AWS accepts."""
+
+    def __init__(self, concurrency):
+        self.concurrency = concurrency
+        self.limit = concurrency
+        self.in_flight = 0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        with self.condition:
+            while self.in_flight >= self.limit:
+                self.condition.wait()
+            self.in_flight += 1
+
+    def release(self, throttled=False):
+        with self.condition:
+            self.in_flight -= 1
+            if throttled:
+                self.limit = max(1, self.limit // 2)
+            elif self.limit < self.concurrency:
+                self.limit += 1
+            self.condition.notify_all()
+
+    def backoff(self, retry):
+        # Full jitter, so the throttled invocations don't come back together
+        time.sleep(random.uniform(0, min(Config.batch_backoff_max, Config.batch_backoff_base * 2 ** retry)))
+
 class AwsClient(object):
+    """The boto3 session and the clients are shared by all the instances.
+    Creating a client loads the service model and opens a new connection pool,
+    so each client is created once per service and region."""
+
+    session = None
+    clients = {}
+    lock = threading.Lock()
     
     def get_user_name(self):
         try:
@@ -467,17 +761,33 @@ class AwsClient(object):
             return StringUtils().find_expression('(?<=user\/)(\S+)', str(ce))
         
     def get_access_key(self):
-        session = boto3.Session()
-        credentials = session.get_credentials()
+        credentials = self.get_session().get_credentials()
         return credentials.access_key
+
+    def get_session(self):
+        if AwsClient.session is None:
+            # boto3 takes most of the start up time, only load it when needed
+            import boto3
+            AwsClient.session = boto3.Session()
+        return AwsClient.session
     
-    def get_boto3_client(self, client_name, region=None): 
+    def get_boto3_client(self, client_name, region=None, retries=None): 
         if region is None:
             region = Config.lambda_region
-        return boto3.client(client_name, region_name=region)    
+        key = (client_name, region, retries)
+        # boto3 sessions are not thread safe but the clients are
+        with AwsClient.lock:
+            if key not in AwsClient.clients:
+                from botocore.config import Config as BotoConfig
+                boto_config = BotoConfig(max_pool_connections=Config.boto_max_pool_connections)
+                if retries is not None:
+                    boto_config = boto_config.merge(BotoConfig(retries={'max_attempts' : retries}))
+                AwsClient.clients[key] = self.get_session().client(client_name, region_name=region,
+                                                                   config=boto_config)
+            return AwsClient.clients[key]
     
-    def get_lambda(self, region=None):
-        return self.get_boto3_client('lambda', region)
+    def get_lambda(self, region=None, retries=None):
+        return self.get_boto3_client('lambda', region, retries)
     
     def get_log(self, region=None):
         return self.get_boto3_client('logs', region)
@@ -491,17 +801,26 @@ class AwsClient(object):
     def get_s3(self, region=None):
         return self.get_boto3_client('s3', region)    
     
-    def find_function_name(self, function_name):
+    def get_function_info(self, function_name, refresh=False):
+        """Metadata of the function from the local cache or, if it is not cached
+        or refresh is set, from AWS. None if the function doesn't exist."""
+        cache = FunctionCache()
+        if not refresh:
+            function = cache.get(function_name)
+            if function:
+                return function
         try:
-            paginator = AwsClient().get_lambda().get_paginator('list_functions')  
-            for functions in paginator.paginate():         
-                for lfunction in functions['Functions']:
-                    if function_name == lfunction['FunctionName']:
-                        return True
-            return False
+            configuration = self.get_lambda().get_function_configuration(FunctionName=function_name)
         except ClientError as ce:
-            print ("Error listing the lambda functions: %s" % ce)
-            sys.exit(1)  
+            if ce.response['Error']['Code'] == 'ResourceNotFoundException':
+                cache.remove(function_name)
+                return None
+            print ("Error getting the lambda function: %s" % ce)
+            sys.exit(1)
+        return cache.update([configuration])[0]
+
+    def find_function_name(self, function_name, refresh=False):
+        return self.get_function_info(function_name, refresh) is not None
     
     def check_function_name_not_exists(self, function_name, json):     
         if not self.find_function_name(function_name):
@@ -512,17 +831,46 @@ class AwsClient(object):
             sys.exit(1)
 
     def check_function_name_exists(self, function_name, json):
-        if self.find_function_name(function_name):
+        # Don't trust the cache, the function may have been deleted out of scar
+        if self.find_function_name(function_name, refresh=True):
             if json:
                 StringUtils().print_json({"Error" : "Function '%s' already exists." % function_name})
             else:
                 print ("Error: Function '%s' already exists." % function_name)
             sys.exit(1)
             
+    def invoke_function(self, function_name, invocation_type, payload, throttle):
+        """Invoke the function retrying while it is throttled.
+        Returns the response, the number of retries and the latency of the invocation."""
+        retry = 0
+        while True:
+            throttle.acquire()
+            start = time.time()
+            try:
+                # The retries of botocore would hide the throttling from the InvocationThrottle
+                response = self.get_lambda(retries=0).invoke(FunctionName=function_name,
+                                                             InvocationType=invocation_type,
+                                                             Payload=payload)
+                # Read the payload here, it is part of the latency
+                response['Payload'] = io.BytesIO(response['Payload'].read())
+                throttle.release()
+                return response, retry, round(time.time() - start, 3)
+            except ClientError as ce:
+                throttled = (ce.response['Error']['Code'] == 'TooManyRequestsException')
+                throttle.release(throttled)
+                if not throttled or retry >= Config.batch_max_retries:
+                    raise
+            except Exception:
+                throttle.release()
+                raise
+            throttle.backoff(retry)
+            retry += 1
+
     def update_function_timeout(self, function_name, timeout):
         try:           
             self.get_lambda().update_function_configuration(FunctionName=function_name,
                                                                    Timeout=self.check_time(timeout))
+            FunctionCache().remove(function_name)
         except ClientError as ce:
             print ("Error updating lambda function timeout: %s" % ce)
 
@@ -530,6 +878,7 @@ class AwsClient(object):
         try:           
             self.get_lambda().update_function_configuration(FunctionName=function_name,
                                                                    MemorySize=self.check_memory(memory))
+            FunctionCache().remove(function_name)
         except ClientError as ce:
             print ("Error updating lambda function memory: %s" % ce)
 
@@ -609,31 +958,49 @@ class AwsClient(object):
         except ClientError as ce:
             print ("Error creating the S3 bucket '%s' folders: %s" % (bucket_name, ce))
             
+    def upload_container_archive(self, bucket_name, function_name, archive_path):
+        file_key = "scar/%s/%s" % (function_name, Config.container_archive_name)
+        try:
+            self.get_s3().upload_file(archive_path, bucket_name, file_key)
+        except ClientError as ce:
+            print ("Error uploading the container archive to the S3 bucket '%s': %s" % (bucket_name, ce))
+            sys.exit(1)
+        return "s3://%s/%s" % (bucket_name, file_key)
+
     def get_functions_arn_list(self):
         arn_list = []
         # Creation of a function filter by tags
         client = self.get_resource_groups_tagging_api()
         tag_filters = [ { 'Key': 'owner', 'Values': [ self.get_user_name() ] },
                         { 'Key': 'createdby', 'Values': ['scar'] } ]
-        try:        
-            response = client.get_resources(TagFilters=tag_filters,
-                                                 TagsPerPage=100)
+        try:
+            # The log groups have the same tags, only list the functions
+            paginator = client.get_paginator('get_resources')
+            for response in paginator.paginate(TagFilters=tag_filters,
+                                               ResourceTypeFilters=['lambda:function'],
+                                               ResourcesPerPage=100):
+                for function in response['ResourceTagMappingList']:
+                    arn_list.append(function['ResourceARN'])
         except ClientError as ce:
             print ("Error getting function arn by tag: %s" % ce)         
-        for function in response['ResourceTagMappingList']:
-            arn_list.append(function['ResourceARN'])
         return arn_list
 
-    def get_all_functions(self):
-        function_list = []
-        # Get the filtered resources from AWS
-        filtered_functions = self.get_functions_arn_list()
+    def get_function(self, function_arn):
         try:
-            for function_arn in filtered_functions:
-                function_list.append(self.get_lambda().get_function(FunctionName=function_arn))
+            return self.get_lambda().get_function(FunctionName=function_arn)
         except ClientError as ce:
-            print ("Error getting function info by arn: %s" % ce)                
-        return function_list
+            print ("Error getting function info by arn: %s" % ce)
+
+    def get_all_functions(self, function_arns=None):
+        """Yields the information of the functions as it arrives"""
+        if function_arns is None:
+            # Get the filtered resources from AWS
+            function_arns = self.get_functions_arn_list()
+        with ThreadPoolExecutor(max_workers=Config.aws_max_workers) as executor:
+            futures = [executor.submit(self.get_function, function_arn) for function_arn in function_arns]
+            for future in as_completed(futures):
+                if future.result():
+                    yield future.result()
     
     def delete_lambda_function(self, function_name, result):
         try:
@@ -645,6 +1012,8 @@ class AwsClient(object):
             result.append_to_plain_text("Function '%s' successfully deleted." % function_name)
         except ClientError as ce:
             print ("Error deleting the lambda function: %s" % ce)
+        # Also if it was already deleted out of scar
+        FunctionCache().remove(function_name)
 
     def delete_cloudwatch_group(self, function_name, result):
         try:           
@@ -662,12 +1031,15 @@ class AwsClient(object):
                 print ("Error deleting the cloudwatch log: %s" % ce)
 
     def delete_resources(self, function_name, json, verbose):
-        result = Result()
         self.check_function_name_not_exists(function_name, json or verbose)       
+        # Show results
+        self.delete_function_resources(function_name).print_results(json, verbose)
+
+    def delete_function_resources(self, function_name):
+        result = Result()
         self.delete_lambda_function(function_name, result)
         self.delete_cloudwatch_group(function_name, result)
-        # Show results
-        result.print_results(json, verbose)        
+        return result
 
 class Result(object):
 
@@ -703,7 +1075,23 @@ class Result(object):
         else:
             self.print_plain_text_result()
     
+    def print_json_line(self, value):
+        sys.stdout.write(json.dumps(value) + '\n')
+        sys.stdout.flush()
+
+    def print_table_header(self, function_names):
+        # The names are known before the rows arrive, the other columns have fixed widths
+        name_width = max([len('NAME') + 2] + [len(name) for name in function_names])
+        self.row_format = "%%-%ds  %%8s  %%6s  %%s" % name_width
+        print (self.row_format % ('NAME', 'MEMORY', 'TIME', 'IMAGE_ID'))
+        print (self.row_format % ('-' * name_width, '-' * 8, '-' * 6, '-' * 10))
+
+    def print_table_row(self, function):
+        sys.stdout.write(self.row_format % (function['Name'], function['Memory'], function['Timeout'], function['Image_id']) + '\n')
+        sys.stdout.flush()
+
     def generate_table(self, functions_info):
+        from tabulate import tabulate
         headers = ['NAME', 'MEMORY', 'TIME', 'IMAGE_ID']
         table = []
         for function in functions_info:
@@ -746,11 +1134,15 @@ class CmdParser(object):
         parser_init.add_argument("-v", "--verbose", help="Show the complete aws output in json format", action="store_true")
         parser_init.add_argument("-s", "--script", help="Path to the input file passed to the function")
         parser_init.add_argument("-es", "--event_source", help="Name specifying the source of the events that will launch the lambda function. Only supporting buckets right now.")                  
+        parser_init.add_argument("-p", "--prebuild", help="Build the container locally and ship it in the function package", action="store_true")
+        parser_init.add_argument("-lc", "--layer_cache", help="Name of the S3 bucket used as a shared cache of the container image layers")
+        parser_init.add_argument("-pb", "--prebuild_bucket", help="Build the container locally and store it in the specified S3 bucket")
     
         # 'ls' command
         parser_ls = subparsers.add_parser('ls', help="List lambda functions")
         parser_ls.set_defaults(func=scar.ls)
         parser_ls.add_argument("-j", "--json", help="Return data in JSON format", action="store_true")
+        parser_ls.add_argument("-s", "--stream", help="Show each function as soon as it is retrieved, with --json one JSON object per line", action="store_true")
         parser_ls.add_argument("-v", "--verbose", help="Show the complete aws output in json format", action="store_true")
         
         # 'run' command
@@ -764,6 +1156,8 @@ class CmdParser(object):
         parser_run.add_argument("-s", "--script", nargs='?', type=argparse.FileType('r'), help="Path to the input file passed to the function")        
         parser_run.add_argument("-j", "--json", help="Return data in JSON format", action="store_true")
         parser_run.add_argument("-v", "--verbose", help="Show the complete aws output in json format", action="store_true")
+        parser_run.add_argument("-b", "--batch", type=argparse.FileType('r'), help="File with a JSON payload per line ('-' for stdin). The function is invoked once for each payload and the results are printed as JSON lines.")
+        parser_run.add_argument("-c", "--concurrency", type=int, default=Config.batch_concurrency, help="Maximum number of invocations in flight in batch mode. Default %d." % Config.batch_concurrency)
         parser_run.add_argument('cont_args', nargs=argparse.REMAINDER, help="Arguments passed to the container.")
         
         # Create the parser for the 'rm' command
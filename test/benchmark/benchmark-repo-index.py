@@ -0,0 +1,73 @@
+#! /usr/bin/python
+
+# SCAR - Serverless Container-aware ARchitectures
+# Copyright (C) GRyCAP - I3M - UPV
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Compares the listings of the udocker repository served from the index
+# with the walk of the repository directories. Usage:
+#   python benchmark-repo-index.py [num_images] [num_containers]
+
+import imp
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+udocker = imp.load_source("udocker", os.path.dirname(os.path.realpath(__file__)) + "/../../lambda/udocker")
+
+def create_repo(topdir, num_images, num_containers):
+    localrepo = udocker.LocalRepository(topdir)
+    localrepo.create_repo()
+    for i in range(num_images):
+        localrepo.setup_imagerepo("user/image%d" % i)
+        localrepo.setup_tag("latest")
+        localrepo.set_version("v2")
+        for j in range(5):
+            layer_file = "%s/sha256:%064d" % (localrepo.layersdir, i * 5 + j)
+            open(layer_file, "w").close()
+            localrepo.add_image_layer(layer_file)
+    for i in range(num_containers):
+        localrepo.setup_container("user/image%d" % (i % num_images), "latest", "container%d" % i)
+        localrepo.set_container_name("container%d" % i, "name%d" % i)
+    return localrepo
+
+def timeit(label, function, repeat=10):
+    start = time.time()
+    for dummy in range(repeat):
+        # a new repository object reads the index as a new udocker process
+        function(udocker.LocalRepository(topdir))
+    print("%-40s %8.2f ms" % (label, (time.time() - start) * 1000 / repeat))
+
+def lookups(localrepo):
+    localrepo.get_imagerepos()
+    localrepo.get_containers_list(False)
+    localrepo.get_container_name("container0")
+    localrepo._inrepository("sha256:%064d" % 0)
+
+if __name__ == "__main__":
+    num_images = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    num_containers = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+    topdir = tempfile.mkdtemp()
+    try:
+        create_repo(topdir, num_images, num_containers)
+        print("%d images, %d containers" % (num_images, num_containers))
+        timeit("images/ps/name/layer from index", lookups)
+        timeit("walk of the repository directories", lambda localrepo: localrepo._scan_index())
+        print("index consistent: %s" % udocker.LocalRepository(topdir).check_index())
+        shutil.rmtree(topdir + "/containers/container0")
+        print("index consistent after external removal: %s" % udocker.LocalRepository(topdir).check_index())
+    finally:
+        shutil.rmtree(topdir)
@@ -0,0 +1,109 @@
+#! /usr/bin/python
+
+# SCAR - Serverless Container-aware ARchitectures
+# Copyright (C) GRyCAP - I3M - UPV
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Measures the wall time of whole scar processes for 'scar --help',
+# 'scar ls' and 'scar run'. The AWS requests are answered in-process with
+# canned responses, so only the scar and boto3 overhead is measured. Usage:
+#   python benchmark-startup.py [repeat] [num_functions]
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+SCAR = os.path.dirname(os.path.realpath(__file__)) + "/../../scar.py"
+
+# Runs scar.py answering the requests that reach the botocore endpoints
+DRIVER = r'''
+import base64, io, json, sys
+from urllib.parse import unquote
+import botocore.endpoint
+from botocore.awsrequest import AWSResponse
+
+NUM_FUNCTIONS = int(sys.argv.pop(1))
+USER = (b'<GetUserResponse xmlns="https://iam.amazonaws.com/doc/2010-05-08/"><GetUserResult><User>'
+        b'<Path>/</Path><UserName>bench</UserName><UserId>AIDABENCH</UserId>'
+        b'<Arn>arn:aws:iam::123456789012:user/bench</Arn><CreateDate>2017-01-01T00:00:00Z</CreateDate>'
+        b'</User></GetUserResult><ResponseMetadata><RequestId>1</RequestId></ResponseMetadata></GetUserResponse>')
+ARN = "arn:aws:lambda:us-east-1:123456789012:function:scar-bench-%d"
+
+class Body(io.BytesIO):
+    def stream(self, **kwargs):
+        yield self.read()
+
+def function(name):
+    return {"FunctionName": name, "FunctionArn": ARN % 0, "MemorySize": 128, "Timeout": 300,
+            "Environment": {"Variables": {"IMAGE_ID": "ubuntu:16.04"}}}
+
+def response(request):
+    headers = {"x-amzn-RequestId": "1"}
+    path = request.url.split("?")[0]
+    if "iam." in request.url:
+        return 200, headers, USER
+    if "tagging." in request.url:
+        mappings = [{"ResourceARN": ARN % i, "Tags": []} for i in range(NUM_FUNCTIONS)]
+        return 200, headers, json.dumps({"ResourceTagMappingList": mappings}).encode()
+    if path.endswith("/invocations"):
+        headers["X-Amz-Log-Result"] = base64.b64encode(b"START\nEND\nREPORT\n").decode()
+        payload = "SCAR: Request Id: 1\nLog group name: /aws/lambda/bench\nLog stream name: stream\nhello\n"
+        return 200, headers, json.dumps(payload).encode()
+    if path.endswith("/functions/"):
+        return 200, headers, json.dumps({"Functions": [function("scar-bench")]}).encode()
+    if path.endswith("/configuration"):
+        return 200, headers, json.dumps(function(unquote(path.split("/")[-2]))).encode()
+    if "/functions/" in path:
+        name = unquote(path.rstrip("/").split("/")[-1]).split(":")[-1]
+        return 200, headers, json.dumps({"Configuration": function(name), "Code": {}}).encode()
+    return 404, headers, b"{}"
+
+def send(self, request):
+    status, headers, body = response(request)
+    return AWSResponse(request.url, status, headers, Body(body))
+
+botocore.endpoint.Endpoint._send = send
+sys.path.insert(0, sys.argv[1].rsplit("/", 1)[0])
+sys.argv = sys.argv[1:]
+import scar
+scar.CmdParser().execute()
+'''
+
+def timeit(label, cmd, env, repeat):
+    start = time.time()
+    for dummy in range(repeat):
+        subprocess.check_call(cmd, env=env, stdout=subprocess.DEVNULL)
+    print("%-24s %8.1f ms" % (label, (time.time() - start) * 1000 / repeat))
+
+def main():
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    num_functions = sys.argv[2] if len(sys.argv) > 2 else "20"
+    home = tempfile.mkdtemp()
+    env = dict(os.environ, HOME=home, AWS_ACCESS_KEY_ID="AKIABENCH", AWS_SECRET_ACCESS_KEY="secret",
+               AWS_DEFAULT_REGION="us-east-1", AWS_CONFIG_FILE="/dev/null",
+               AWS_SHARED_CREDENTIALS_FILE="/dev/null")
+    driver = [sys.executable, "-c", DRIVER, num_functions, SCAR]
+    try:
+        timeit("python", [sys.executable, "-c", "pass"], env, repeat)
+        timeit("scar --help", [sys.executable, SCAR, "--help"], env, repeat)
+        timeit("scar ls (%s functions)" % num_functions, driver + ["ls"], env, repeat)
+        timeit("scar run", driver + ["run", "scar-bench"], env, repeat)
+    finally:
+        shutil.rmtree(home)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+#! /usr/bin/python
+
+# SCAR - Serverless Container-aware ARchitectures
+# Copyright (C) GRyCAP - I3M - UPV
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Compares the extraction of image layers with the tar and the python
+# engines of udocker. Usage:
+#   python benchmark-untar.py [layer.tar ...]
+# The layers of a real image can be found in ~/.udocker/repos/<image>/<tag>
+# after 'udocker pull'. Without arguments, synthetic layers are generated.
+
+import imp
+import io
+import os
+import shutil
+import stat
+import sys
+import tarfile
+import tempfile
+import time
+
+udocker = imp.load_source("udocker", os.path.dirname(os.path.realpath(__file__)) + "/../../lambda/udocker")
+
+def add_file(tar, name, data=b"", mode=0o644):
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    info.mode = mode
+    info.mtime = 1500000000
+    tar.addfile(info, io.BytesIO(data))
+
+def add_entry(tar, name, entry_type, mode=0o755, linkname=""):
+    info = tarfile.TarInfo(name)
+    info.type = entry_type
+    info.mode = mode
+    info.mtime = 1500000000
+    info.linkname = linkname
+    tar.addfile(info)
+
+def create_layers(layers_dir, num_files):
+    base = layers_dir + "/base.tar"
+    with tarfile.open(base, "w") as tar:
+        add_entry(tar, "usr", tarfile.DIRTYPE)
+        add_entry(tar, "usr/lib", tarfile.DIRTYPE, 0o555)
+        for i in range(num_files):
+            add_file(tar, "usr/lib/file%d" % i, b"x" * (i % 512), 0o444 if i % 3 else 0o755)
+        add_entry(tar, "usr/lib/link", tarfile.SYMTYPE, linkname="file1")
+        add_entry(tar, "usr/lib/hard", tarfile.LNKTYPE, linkname="usr/lib/file2")
+        add_entry(tar, "etc", tarfile.DIRTYPE)
+        add_file(tar, "etc/removed", b"removed")
+        add_entry(tar, "etc/removed.d", tarfile.DIRTYPE)
+        add_file(tar, "etc/removed.d/conf", b"conf")
+    upper = layers_dir + "/upper.tar"
+    with tarfile.open(upper, "w") as tar:
+        add_file(tar, "etc/.wh.removed")
+        add_file(tar, "etc/.wh.removed.d")
+        add_file(tar, "usr/lib/file0", b"overwritten", 0o600)
+        add_file(tar, "opt/new/file", b"new")
+    return [base, upper]
+
+def get_tree(root):
+    tree = {}
+    for dir_path, dir_names, file_names in os.walk(root):
+        for name in dir_names + file_names:
+            path = os.path.join(dir_path, name)
+            stat_info = os.lstat(path)
+            entry = [stat.S_IFMT(stat_info.st_mode), stat.S_IMODE(stat_info.st_mode)]
+            if os.path.islink(path):
+                entry.append(os.readlink(path))
+            elif os.path.isfile(path):
+                entry.append(stat_info.st_size)
+                entry.append(int(stat_info.st_mtime))
+            tree[os.path.relpath(path, root)] = entry
+    return tree
+
+def extract(engine, layers, destdir):
+    udocker.Config.untar_engine = engine
+    start = time.time()
+    status = udocker.ContainerStructure(None)._untar_layers(layers, destdir)
+    return status, time.time() - start
+
+def main():
+    work_dir = tempfile.mkdtemp()
+    try:
+        layers = sys.argv[1:]
+        if not layers:
+            os.mkdir(work_dir + "/layers")
+            layers = create_layers(work_dir + "/layers", 5000)
+        results = {}
+        for engine in ("tar", "python"):
+            destdir = "%s/%s/ROOT" % (work_dir, engine)
+            os.makedirs(destdir)
+            status, elapsed = extract(engine, layers, destdir)
+            results[engine] = get_tree(destdir)
+            print("%-7s %s %.2f s, %d files" % (engine, "ok" if status else "error", elapsed, len(results[engine])))
+        differences = [name for name in set(results["tar"]) | set(results["python"])
+                       if results["tar"].get(name) != results["python"].get(name)]
+        for name in sorted(differences):
+            print("different: %s tar=%s python=%s" % (name, results["tar"].get(name), results["python"].get(name)))
+        print("identical" if not differences else "%d differences" % len(differences))
+    finally:
+        for dir_path, dummy, dummy in os.walk(work_dir):
+            os.chmod(dir_path, stat.S_IRWXU)
+        shutil.rmtree(work_dir)
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,39 @@
 import unittest
+import os
+import argparse
+import contextlib
+import io
+import json
+import shutil
+import subprocess
 import sys
+import tarfile
+import tempfile
 
 sys.path.append(".")
 sys.path.append("..")
 
-from scar import Scar
+from botocore.response import StreamingBody
+from botocore.stub import Stubber
+import scar
+from scar import Scar, AwsClient, Config, FunctionCache, InvocationThrottle, StringUtils
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+SCAR_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "..")
+
+@contextlib.contextmanager
+def captured_output():
+    """Capture the stdout and discard the stderr of the block, with python 2 and 3"""
+    stdout, stderr = sys.stdout, sys.stderr
+    sys.stdout, sys.stderr = StringIO(), StringIO()
+    try:
+        yield sys.stdout
+    finally:
+        sys.stdout, sys.stderr = stdout, stderr
 
 class TestScar(unittest.TestCase):
         
@@ -34,5 +63,300 @@ class TestScar(unittest.TestCase):
         self.assertEqual(300, Scar().check_time(300))
         self.assertEqual(147, Scar().check_time(147))
 
+class TestAwsClient(unittest.TestCase):
+
+    def setUp(self):
+        os.environ.setdefault("AWS_ACCESS_KEY_ID", "AKIATEST")
+        os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "secret")
+        AwsClient.clients.clear()
+
+    def test_clients_shared(self):
+        lambda_client = AwsClient().get_lambda()
+        self.assertIs(lambda_client, AwsClient().get_lambda())
+        self.assertIs(AwsClient().session, AwsClient().get_session())
+        self.assertIsNot(lambda_client, AwsClient().get_lambda('eu-west-1'))
+        self.assertEqual('eu-west-1', AwsClient().get_lambda('eu-west-1').meta.region_name)
+        self.assertIsNot(lambda_client, AwsClient().get_log())
+
+    def test_lazy_imports(self):
+        code = "import sys, scar; print(sorted(set(['boto3', 'tabulate']) & set(sys.modules)))"
+        output = subprocess.check_output([sys.executable, "-c", code], cwd=SCAR_DIR)
+        self.assertEqual(b"[]", output.strip())
+
+class TestContainerArchive(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.udocker_dir = self.tmp_dir + "/home/.udocker"
+        self.config = (Config.lambda_env_variables['Variables']['UDOCKER_DIR'], Config.container_archive_path)
+        Config.lambda_env_variables['Variables']['UDOCKER_DIR'] = self.udocker_dir
+        Config.container_archive_path = self.tmp_dir + "/container.tar.gz"
+        self.commands = []
+        self.failed = None
+
+    def tearDown(self):
+        scar.call = subprocess.call
+        (Config.lambda_env_variables['Variables']['UDOCKER_DIR'], Config.container_archive_path) = self.config
+        shutil.rmtree(self.tmp_dir)
+
+    def udocker(self, cmd, env=None):
+        """udocker run by scar, creates the container files"""
+        self.commands.append(cmd[1:])
+        self.assertEqual(self.udocker_dir, env['UDOCKER_DIR'])
+        if cmd[1] == self.failed:
+            return 1
+        if cmd[1] == "create":
+            os.makedirs(self.udocker_dir + "/containers/id-1/ROOT/bin")
+            with open(self.udocker_dir + "/containers/id-1/ROOT/bin/sh", "w") as f:
+                f.write("sh")
+            os.symlink("id-1", self.udocker_dir + "/containers/lambda_cont")
+        return 0
+
+    def test_create_container_archive(self):
+        scar.call = self.udocker
+        self.assertEqual(Config.container_archive_path, Scar().create_container_archive("grycap/cowsay"))
+        self.assertEqual([["pull", "grycap/cowsay"], ["create", "--name=lambda_cont", "grycap/cowsay"],
+                          ["setup", "--execmode=F1", "lambda_cont"]], self.commands)
+        with tarfile.open(Config.container_archive_path) as tar:
+            members = dict((member.name, member) for member in tar.getmembers())
+            self.assertEqual(["containers/id-1", "containers/id-1/ROOT", "containers/id-1/ROOT/bin",
+                              "containers/id-1/ROOT/bin/sh", "containers/lambda_cont"], sorted(members))
+            self.assertEqual("id-1", members["containers/lambda_cont"].linkname)
+            self.assertEqual(b"sh", tar.extractfile("containers/id-1/ROOT/bin/sh").read())
+
+    def test_create_container_archive_failed(self):
+        scar.call = self.udocker
+        self.failed = "setup"
+        with self.assertRaises(Exception) as context:
+            Scar().create_container_archive("grycap/cowsay")
+        self.assertIn("'udocker setup --execmode=F1 lambda_cont' failed", str(context.exception))
+        self.assertFalse(os.path.exists(Config.container_archive_path))
+
+class TestFunctionCache(unittest.TestCase):
+
+    def setUp(self):
+        os.environ.setdefault("AWS_ACCESS_KEY_ID", "AKIATEST")
+        os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "secret")
+        self.home = tempfile.mkdtemp()
+        os.mkdir(self.home + "/.scar")
+        self.environ_home = os.environ.get("HOME")
+        os.environ["HOME"] = self.home
+        self.stubber = Stubber(AwsClient().get_lambda())
+        self.stubber.activate()
+
+    def tearDown(self):
+        self.stubber.deactivate()
+        os.environ["HOME"] = self.environ_home
+        shutil.rmtree(self.home)
+        Config.function_cache_ttl = 300
+
+    def configuration(self, name):
+        return {'FunctionName' : name,
+                'FunctionArn' : 'arn:aws:lambda:us-east-1:123456789012:function:' + name,
+                'MemorySize' : 256,
+                'Timeout' : 60,
+                'Environment' : {'Variables' : {'IMAGE_ID' : 'grycap/cowsay'}}}
+
+    def test_function_info_cached(self):
+        self.stubber.add_response('get_function_configuration', self.configuration('cowsay'),
+                                  {'FunctionName' : 'cowsay'})
+        function = AwsClient().get_function_info('cowsay')
+        self.assertEqual(('cowsay', 256, 60, 'grycap/cowsay'),
+                         (function['Name'], function['Memory'], function['Timeout'], function['Image_id']))
+        # Answered from the cache, the stubber fails on unexpected calls
+        self.assertTrue(AwsClient().find_function_name('cowsay'))
+        self.stubber.assert_no_pending_responses()
+
+    def test_function_not_found(self):
+        FunctionCache().update([self.configuration('cowsay')])
+        self.stubber.add_client_error('get_function_configuration', 'ResourceNotFoundException')
+        self.assertFalse(AwsClient().find_function_name('cowsay', refresh=True))
+        self.assertIsNone(FunctionCache().get('cowsay'))
+
+    def test_cache_expires(self):
+        FunctionCache().update([self.configuration('cowsay')])
+        self.assertIsNotNone(FunctionCache().get('cowsay'))
+        Config.function_cache_ttl = 0
+        self.assertIsNone(FunctionCache().get('cowsay'))
+
+    def test_cache_regions_and_replace(self):
+        FunctionCache().update([self.configuration('cowsay'), self.configuration('other')])
+        self.assertIsNone(FunctionCache().get('cowsay', region='eu-west-1'))
+        FunctionCache().update([self.configuration('other')], replace=True)
+        self.assertIsNone(FunctionCache().get('cowsay'))
+        self.assertIsNotNone(FunctionCache().get('other'))
+        FunctionCache().remove('other')
+        self.assertEqual({'us-east-1' : {}}, FunctionCache().load())
+
+class TestBatchRun(unittest.TestCase):
+
+    def setUp(self):
+        os.environ.setdefault("AWS_ACCESS_KEY_ID", "AKIATEST")
+        os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "secret")
+        Config.batch_backoff_base = 0
+        self.stubber = Stubber(AwsClient().get_lambda(retries=0))
+        self.stubber.activate()
+
+    def tearDown(self):
+        self.stubber.deactivate()
+        Config.batch_backoff_base = 0.1
+
+    def add_invoke_response(self, payload):
+        self.stubber.add_response('invoke', {'StatusCode' : 200,
+                                             'Payload' : StreamingBody(io.BytesIO(payload), len(payload)),
+                                             'ResponseMetadata' : {'RequestId' : 'request-id'}})
+
+    def run_batch(self, lines):
+        args = argparse.Namespace(name='cowsay', batch=StringIO("\n".join(lines) + "\n"), concurrency=1)
+        with captured_output() as output:
+            try:
+                Scar().run_batch(args, AwsClient(), 'RequestResponse')
+            except SystemExit:
+                pass
+        return [json.loads(line) for line in output.getvalue().splitlines()]
+
+    def test_parse_batch_payload(self):
+        payload = '{"script": "echo", "cmd_args": ["-n"], "env": {"A": "1"}}'
+        self.assertEqual(json.loads(payload), json.loads(StringUtils().parse_batch_payload(payload)))
+        for line in ['[]', '{"args": []}', '{"cmd_args": "echo"}', '{"env": ["A=1"]}', 'echo']:
+            with self.assertRaises(ValueError):
+                StringUtils().parse_batch_payload(line)
+
+    def test_throttled_invocation_retried(self):
+        self.stubber.add_client_error('invoke', 'TooManyRequestsException', http_status_code=429)
+        self.add_invoke_response(b'"hello\\n"')
+        self.stubber.add_client_error('invoke', 'ResourceNotFoundException', http_status_code=404)
+        results = self.run_batch(['{"cmd_args": ["echo", "hello"]}', '', '{"cmd_args": ["echo"]}', '{"bad": 1}'])
+        self.stubber.assert_no_pending_responses()
+        results = dict((result['Line'], result) for result in results)
+        self.assertEqual([1, 3, 4], sorted(results))
+        self.assertEqual((1, 200, 'request-id', 'hello\n'),
+                         (results[1]['Retries'], results[1]['StatusCode'], results[1]['RequestId'],
+                          results[1]['Payload']))
+        self.assertIn('Latency', results[1])
+        self.assertIn('ResourceNotFoundException', results[3]['Error'])
+        self.assertIn('Invalid payload', results[4]['Error'])
+
+    def test_unexpected_error_in_one_line(self):
+        self.add_invoke_response(b'"hello\\n"')
+        # A response without the expected fields fails only its line
+        self.stubber.add_response('invoke', {'StatusCode' : 200,
+                                             'Payload' : StreamingBody(io.BytesIO(b'""'), 2)})
+        self.add_invoke_response(b'"bye\\n"')
+        results = self.run_batch(['{"cmd_args": ["echo", "hello"]}', '{"cmd_args": ["echo"]}',
+                                  '{"cmd_args": ["echo", "bye"]}'])
+        self.stubber.assert_no_pending_responses()
+        results = dict((result['Line'], result) for result in results)
+        self.assertEqual([1, 2, 3], sorted(results))
+        self.assertEqual('hello\n', results[1]['Payload'])
+        self.assertEqual("KeyError: 'ResponseMetadata'", results[2]['Error'])
+        self.assertEqual('bye\n', results[3]['Payload'])
+
+    def test_invocation_throttle(self):
+        throttle = InvocationThrottle(8)
+        for dummy in range(3):
+            throttle.acquire()
+            throttle.release(throttled=True)
+        self.assertEqual(1, throttle.limit)
+        for dummy in range(20):
+            throttle.acquire()
+            throttle.release()
+        self.assertEqual(8, throttle.limit)
+        self.assertEqual(0, throttle.in_flight)
+
+class TestListAndRemove(unittest.TestCase):
+
+    def setUp(self):
+        os.environ.setdefault("AWS_ACCESS_KEY_ID", "AKIATEST")
+        os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "secret")
+        self.home = tempfile.mkdtemp()
+        os.mkdir(self.home + "/.scar")
+        self.environ_home = os.environ.get("HOME")
+        os.environ["HOME"] = self.home
+        self.stubbers = {}
+        for service in ['iam', 'resourcegroupstaggingapi', 'lambda', 'logs']:
+            self.stubbers[service] = Stubber(AwsClient().get_boto3_client(service))
+            self.stubbers[service].activate()
+        self.stubbers['iam'].add_response('get_user', {'User' : {'Path' : '/', 'UserName' : 'user', 'UserId' : 'AIDAUSERIDENTIFIER',
+                                                                 'Arn' : 'arn:aws:iam::123456789012:user/user',
+                                                                 'CreateDate' : '2017-01-01T00:00:00Z'}})
+        # Two pages of functions
+        arn = 'arn:aws:lambda:us-east-1:123456789012:function:%s'
+        self.names = ['scar-%d' % i for i in range(3)]
+        self.stubbers['resourcegroupstaggingapi'].add_response('get_resources', {
+            'ResourceTagMappingList' : [{'ResourceARN' : arn % name} for name in self.names[:2]],
+            'PaginationToken' : 'next'})
+        self.stubbers['resourcegroupstaggingapi'].add_response('get_resources', {
+            'ResourceTagMappingList' : [{'ResourceARN' : arn % self.names[2]}], 'PaginationToken' : ''},
+            {'TagFilters' : [{'Key' : 'owner', 'Values' : ['user']}, {'Key' : 'createdby', 'Values' : ['scar']}],
+             'ResourceTypeFilters' : ['lambda:function'], 'ResourcesPerPage' : 100, 'PaginationToken' : 'next'})
+
+    def tearDown(self):
+        for stubber in self.stubbers.values():
+            stubber.deactivate()
+        os.environ["HOME"] = self.environ_home
+        shutil.rmtree(self.home)
+
+    def command(self, args):
+        with captured_output() as output:
+            args.func(args)
+        for stubber in self.stubbers.values():
+            stubber.assert_no_pending_responses()
+        return output.getvalue()
+
+    def ls(self, json=False, stream=False):
+        for name in self.names:
+            # The functions are requested concurrently, in any order
+            self.stubbers['lambda'].add_response('get_function', {'Configuration' : {
+                'FunctionName' : name, 'FunctionArn' : 'arn', 'MemorySize' : 128, 'Timeout' : 300,
+                'Environment' : {'Variables' : {'IMAGE_ID' : 'ubuntu'}}}})
+        return self.command(argparse.Namespace(func=Scar().ls, verbose=False, json=json, stream=stream))
+
+    def assert_table(self, lines):
+        self.assertEqual(['NAME', 'MEMORY', 'TIME', 'IMAGE_ID'], lines[0].split())
+        self.assertEqual(sorted(self.names), sorted(line.split()[0] for line in lines[2:]))
+        self.assertEqual([['scar-0', '128', '300', 'ubuntu']], [line.split() for line in lines if 'scar-0' in line])
+
+    def test_ls(self):
+        self.assert_table(self.ls().splitlines())
+        self.assertEqual(sorted(self.names), sorted(FunctionCache().load()['us-east-1']))
+
+    def test_ls_json(self):
+        functions = json.loads(self.ls(json=True))['Functions']
+        self.assertEqual(sorted(self.names), sorted(function['Name'] for function in functions))
+
+    def test_ls_stream(self):
+        self.assert_table(self.ls(stream=True).splitlines())
+
+    def test_ls_stream_json(self):
+        functions = [json.loads(line) for line in self.ls(json=True, stream=True).splitlines()]
+        self.assertEqual(sorted(self.names), sorted(function['Name'] for function in functions))
+        self.assertEqual({'Name' : 'scar-0', 'Memory' : 128, 'Timeout' : 300, 'Image_id' : 'ubuntu'},
+                         [function for function in functions if function['Name'] == 'scar-0'][0])
+
+    def test_ls_failed_function_kept_in_cache(self):
+        FunctionCache().update([{'FunctionName' : name, 'FunctionArn' : 'arn', 'MemorySize' : 128,
+                                 'Timeout' : 300} for name in self.names + ['scar-removed']])
+        for name in self.names[1:]:
+            self.stubbers['lambda'].add_response('get_function', {'Configuration' : {
+                'FunctionName' : name, 'FunctionArn' : 'arn', 'MemorySize' : 256, 'Timeout' : 300,
+                'Environment' : {'Variables' : {'IMAGE_ID' : 'ubuntu'}}}})
+        self.stubbers['lambda'].add_client_error('get_function', 'TooManyRequestsException')
+        self.command(argparse.Namespace(func=Scar().ls, verbose=False, json=False, stream=False))
+        # A transient error does not empty the cache, the listed functions are updated
+        cache = FunctionCache().load()['us-east-1']
+        self.assertEqual(sorted(self.names + ['scar-removed']), sorted(cache))
+        self.assertEqual(2, len([name for name in cache if cache[name]['Memory'] == 256]))
+
+    def test_rm_all(self):
+        metadata = {'ResponseMetadata' : {'RequestId' : 'request-id', 'HTTPStatusCode' : 204}}
+        for dummy in self.names:
+            self.stubbers['lambda'].add_response('delete_function', metadata)
+            self.stubbers['logs'].add_response('delete_log_group', metadata)
+        output = self.command(argparse.Namespace(func=Scar().rm, all=True, name=None, verbose=False, json=False))
+        self.assertEqual(3, output.count("successfully deleted.\nLog group"))
+        for name in self.names:
+            self.assertIn("Function '%s' successfully deleted." % name, output)
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,535 @@
+import unittest
+import io
+import os
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+import uuid
+
+sys.path.append(".")
+sys.path.append("..")
+sys.path.append("lambda")
+sys.path.append("../../lambda")
+
+import scarsupervisor
+
+class FakeS3Client(object):
+
+    def __init__(self, objects=None):
+        self.uploads = []
+        self.objects = dict(objects or {})
+
+    def download_file(self, bucket_name, file_key, file_path, Config=None):
+        with open(file_path, "w") as f:
+            f.write("%s/%s" % (bucket_name, file_key))
+
+    def upload_file(self, file_path, bucket_name, file_key, ExtraArgs=None, Config=None):
+        self.uploads.append((bucket_name, file_key, ExtraArgs))
+
+    def get_object(self, Bucket=None, Key=None):
+        if (Bucket, Key) in self.objects:
+            return {'Body' : io.BytesIO(self.objects[(Bucket, Key)])}
+        return {'Body' : io.BytesIO(("%s/%s" % (Bucket, Key)).encode("utf-8"))}
+
+class FakeUdocker(object):
+
+    def __init__(self, containers=(), images=(), fail=()):
+        self.containers = list(containers)
+        self.images = list(images)
+        self.fail = list(fail)
+        self.calls = []
+
+    def get_container_id(self, name):
+        return name if name in self.containers else None
+
+    def has_image(self, imagespec):
+        return imagespec in self.images
+
+    def pull(self, imagespec, name=None, create=False):
+        self.calls.append(("pull", imagespec, name, create))
+        if "pull" in self.fail:
+            return None
+        self.containers.append(name)
+        return name
+
+    def create(self, imagespec, name=None):
+        self.calls.append(("create", imagespec, name))
+        if "create" in self.fail:
+            return None
+        self.containers.append(name)
+        return name
+
+    def refresh(self, rescan=False):
+        self.calls.append(("refresh", rescan))
+
+    def setup(self, name, execmode):
+        self.calls.append(("setup", name, execmode))
+        return "setup" not in self.fail
+
+    def run(self, run_args, execute):
+        self.calls.append(("run", run_args))
+        if run_args[-1] == "missing":
+            return None
+        return execute(["echo"] + run_args, None, None)
+
+def make_archive(entries):
+    """Container archive of (name, type, data or link name) entries"""
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode="w:gz") as tar:
+        for (name, member_type, data) in entries:
+            info = tarfile.TarInfo(name)
+            info.type = member_type
+            if member_type in (tarfile.SYMTYPE, tarfile.LNKTYPE):
+                info.linkname = data
+            elif member_type == tarfile.DIRTYPE:
+                info.mode = 0o755
+            else:
+                info.size = len(data)
+            tar.addfile(info, io.BytesIO(data) if member_type == tarfile.REGTYPE else None)
+    return buf.getvalue()
+
+class FakeContext(object):
+
+    aws_request_id = "request-id"
+
+    def __init__(self, remaining_time):
+        self.remaining_time = remaining_time
+
+    def get_remaining_time_in_millis(self):
+        return self.remaining_time
+
+class TestScarSupervisor(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        scarsupervisor.warm_marker_path = os.path.join(self.tmp_dir.name, ".scar-warm")
+        scarsupervisor.warm_container_image = None
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_cold_container(self):
+        self.assertFalse(scarsupervisor.is_warm_container("ubuntu:16.04"))
+
+    def test_warm_container(self):
+        scarsupervisor.set_warm_container("ubuntu:16.04")
+        self.assertTrue(scarsupervisor.is_warm_container("ubuntu:16.04"))
+        self.assertFalse(scarsupervisor.is_warm_container("centos:7"))
+
+    def test_warm_container_tmp_wiped(self):
+        scarsupervisor.set_warm_container("ubuntu:16.04")
+        os.remove(scarsupervisor.warm_marker_path)
+        self.assertFalse(scarsupervisor.is_warm_container("ubuntu:16.04"))
+
+    def test_udocker_api_loaded_once(self):
+        os.environ['UDOCKER_DIR'] = os.path.join(self.tmp_dir.name, ".udocker")
+        os.environ['UDOCKER_TARBALL'] = os.path.join(self.tmp_dir.name, "missing.tar.gz")
+        scarsupervisor.udocker_path = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                                   "..", "..", "lambda", "udocker")
+        scarsupervisor.udocker_api = None
+        try:
+            udocker = scarsupervisor.get_udocker()
+            self.assertIs(udocker, scarsupervisor.get_udocker())
+            self.assertEqual([], udocker.images())
+            self.assertFalse(udocker.get_container_id("lambda_cont"))
+            self.assertTrue(os.path.isdir(os.path.join(self.tmp_dir.name, ".udocker", "containers")))
+        finally:
+            scarsupervisor.udocker_api = None
+            del os.environ['UDOCKER_DIR']
+            del os.environ['UDOCKER_TARBALL']
+
+    def test_restore_container_indexed(self):
+        udocker_dir = os.path.join(self.tmp_dir.name, ".udocker")
+        os.environ['UDOCKER_DIR'] = udocker_dir
+        os.environ['UDOCKER_TARBALL'] = os.path.join(self.tmp_dir.name, "missing.tar.gz")
+        scarsupervisor.udocker_path = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                                   "..", "..", "lambda", "udocker")
+        scarsupervisor.udocker_api = None
+        archive_path = os.path.join(self.tmp_dir.name, "container.tar.gz")
+        with open(archive_path, "wb") as f:
+            f.write(make_archive([("containers/lambda_cont", tarfile.SYMTYPE, "id-1"),
+                                  ("containers/id-1/imagerepo.name", tarfile.REGTYPE, b"grycap/cowsay:latest"),
+                                  ("containers/id-1/ROOT/bin/sh", tarfile.REGTYPE, b"sh")]))
+        try:
+            # The index of the repository is created before the restore
+            self.assertEqual([], scarsupervisor.get_udocker().containers())
+            scarsupervisor.restore_container(archive_path)
+            udocker = scarsupervisor.get_udocker()
+            self.assertEqual([("id-1", "grycap/cowsay:latest", str(["lambda_cont"]))], udocker.containers())
+            self.assertEqual("id-1", udocker.get_container_id("lambda_cont"))
+        finally:
+            scarsupervisor.udocker_api = None
+            del os.environ['UDOCKER_DIR']
+            del os.environ['UDOCKER_TARBALL']
+
+    def test_pull_and_create_container(self):
+        scarsupervisor.metrics = scarsupervisor.Metrics(True)
+        scarsupervisor.udocker_api = FakeUdocker(containers=["lambda_cont"])
+        scarsupervisor.pull_and_create_container("ubuntu:16.04")
+        self.assertEqual([], scarsupervisor.udocker_api.calls)
+        scarsupervisor.udocker_api = FakeUdocker(images=["ubuntu:16.04"])
+        scarsupervisor.pull_and_create_container("ubuntu:16.04")
+        self.assertEqual([("create", "ubuntu:16.04", "lambda_cont"), ("setup", "lambda_cont", "F1")],
+                         scarsupervisor.udocker_api.calls)
+        scarsupervisor.udocker_api = FakeUdocker()
+        scarsupervisor.pull_and_create_container("ubuntu:16.04")
+        self.assertEqual([("pull", "ubuntu:16.04", "lambda_cont", True), ("setup", "lambda_cont", "F1")],
+                         scarsupervisor.udocker_api.calls)
+        for (images, fail) in (([], "pull"), (["ubuntu:16.04"], "create"), ([], "setup")):
+            scarsupervisor.udocker_api = FakeUdocker(images=images, fail=[fail])
+            with self.assertRaises(Exception) as context:
+                scarsupervisor.pull_and_create_container("ubuntu:16.04")
+            self.assertIn("could not", str(context.exception))
+        scarsupervisor.udocker_api = None
+
+    def test_prepare_container_failed_pull(self):
+        scarsupervisor.metrics = scarsupervisor.Metrics(True)
+        scarsupervisor.udocker_api = FakeUdocker(fail=["pull"])
+        try:
+            with self.assertRaises(Exception):
+                scarsupervisor.prepare_container("ubuntu:16.04")
+            self.assertFalse(scarsupervisor.is_warm_container("ubuntu:16.04"))
+            # The next invocation tries again
+            scarsupervisor.udocker_api.fail = []
+            scarsupervisor.prepare_container("ubuntu:16.04")
+            self.assertTrue(scarsupervisor.is_warm_container("ubuntu:16.04"))
+            self.assertEqual(2, len([call for call in scarsupervisor.udocker_api.calls if call[0] == "pull"]))
+        finally:
+            scarsupervisor.udocker_api = None
+
+    def restore(self, archive, from_s3=False):
+        udocker_dir = os.path.join(self.tmp_dir.name, "home", ".udocker")
+        os.makedirs(os.path.join(udocker_dir, "containers"))
+        os.environ['UDOCKER_DIR'] = udocker_dir
+        scarsupervisor.udocker_api = FakeUdocker()
+        try:
+            if from_s3:
+                scarsupervisor.S3_Bucket.client = FakeS3Client({('bucket', 'scar/container.tar.gz') : archive})
+                scarsupervisor.restore_container("s3://bucket/scar/container.tar.gz")
+            else:
+                archive_path = os.path.join(self.tmp_dir.name, "container.tar.gz")
+                with open(archive_path, "wb") as f:
+                    f.write(archive)
+                scarsupervisor.restore_container(archive_path)
+        finally:
+            del os.environ['UDOCKER_DIR']
+            scarsupervisor.S3_Bucket.client = None
+            scarsupervisor.udocker_api = None
+        return udocker_dir
+
+    def test_restore_container(self):
+        archive = make_archive([("containers/lambda_cont", tarfile.SYMTYPE, "id-1"),
+                                ("containers/id-1/ROOT/bin", tarfile.DIRTYPE, b""),
+                                ("containers/id-1/ROOT/bin/sh", tarfile.REGTYPE, b"sh"),
+                                ("containers/id-1/ROOT/usr/bin/sh", tarfile.LNKTYPE, "containers/id-1/ROOT/bin/sh"),
+                                ("containers/id-1/ROOT/etc/localtime", tarfile.SYMTYPE, "/usr/share/zoneinfo/UTC")])
+        for from_s3 in (False, True):
+            udocker_dir = self.restore(archive, from_s3)
+            with open(os.path.join(udocker_dir, "containers", "lambda_cont", "ROOT", "usr", "bin", "sh")) as f:
+                self.assertEqual("sh", f.read())
+            self.assertEqual("/usr/share/zoneinfo/UTC",
+                             os.readlink(os.path.join(udocker_dir, "containers", "id-1", "ROOT", "etc", "localtime")))
+            scarsupervisor.call(["rm", "-rf", os.path.join(self.tmp_dir.name, "home")])
+
+    def test_restore_container_rejects_paths(self):
+        outside = os.path.join(self.tmp_dir.name, "outside")
+        os.makedirs(outside)
+        for entries in ([("../../outside/file", tarfile.REGTYPE, b"x")],
+                        [(os.path.join(outside, "file"), tarfile.REGTYPE, b"x")],
+                        [("containers/id-1/../../../outside/file", tarfile.REGTYPE, b"x")],
+                        [("containers/link", tarfile.SYMTYPE, outside),
+                         ("containers/link/file", tarfile.REGTYPE, b"x")],
+                        [("containers/hard", tarfile.LNKTYPE, "../../outside/secret")],
+                        [("containers/link", tarfile.SYMTYPE, os.path.join(outside, "file")),
+                         ("containers/link", tarfile.REGTYPE, b"x")],
+                        [("containers/link", tarfile.SYMTYPE, outside),
+                         ("containers/hard", tarfile.LNKTYPE, "containers/link/secret")],
+                        [("containers/file", tarfile.REGTYPE, b"file"),
+                         ("containers/hard", tarfile.LNKTYPE, "containers/file"),
+                         ("containers/hard", tarfile.REGTYPE, b"x")]):
+            with self.assertRaises(Exception) as context:
+                self.restore(make_archive(entries))
+            self.assertIn("Invalid path", str(context.exception))
+            self.assertEqual([], os.listdir(outside))
+            scarsupervisor.call(["rm", "-rf", os.path.join(self.tmp_dir.name, "home")])
+
+    def test_run_container(self):
+        scarsupervisor.udocker_api = FakeUdocker()
+        try:
+            self.assertEqual("--nosysdirs lambda_cont\n",
+                             scarsupervisor.run_container(["--nosysdirs", "lambda_cont"]))
+            self.assertTrue(scarsupervisor.run_container(["missing"]).startswith("ERROR"))
+        finally:
+            scarsupervisor.udocker_api = None
+
+    def test_create_command_env(self):
+        environ = dict(os.environ)
+        os.environ.update({'UDOCKER_DIR' : self.tmp_dir.name, 'AWS_ACCESS_KEY_ID' : 'key',
+                           'AWS_SECRET_ACCESS_KEY' : 'secret', 'AWS_SESSION_TOKEN' : 'token',
+                           'AWS_SECURITY_TOKEN' : 'token', 'CONT_VAR_MODE' : 'global'})
+        try:
+            command = scarsupervisor.create_command({'cmd_args' : ['echo'], 'env' : {'MODE' : 'sweep', 'N' : 3}},
+                                                    "request-id")
+        finally:
+            os.environ.clear()
+            os.environ.update(environ)
+        self.assertLess(command.index("MODE=global"), command.index("MODE=sweep"))
+        self.assertIn("N=3", command)
+        self.assertEqual(["lambda_cont", "echo"], command[-2:])
+
+    def test_create_command_script(self):
+        request_ids = [str(uuid.uuid4()) for dummy in range(2)]
+        environ = dict(os.environ)
+        os.environ.update({'UDOCKER_DIR' : self.tmp_dir.name, 'AWS_ACCESS_KEY_ID' : 'key',
+                           'AWS_SECRET_ACCESS_KEY' : 'secret', 'AWS_SESSION_TOKEN' : 'token',
+                           'AWS_SECURITY_TOKEN' : 'token'})
+        try:
+            for request_id, script in zip(request_ids, ["echo a", "echo b"]):
+                os.makedirs("/tmp/%s" % request_id)
+                command = scarsupervisor.create_command({'script' : script}, request_id)
+                self.assertEqual(["--entrypoint=/bin/sh /tmp/%s/script.sh" % request_id, "lambda_cont"],
+                                 command[-2:])
+            # Concurrent records do not overwrite the script of each other
+            for request_id, script in zip(request_ids, ["echo a", "echo b"]):
+                with open("/tmp/%s/script.sh" % request_id) as f:
+                    self.assertEqual(script, f.read())
+        finally:
+            os.environ.clear()
+            os.environ.update(environ)
+            scarsupervisor.call(["rm", "-rf"] + ["/tmp/%s" % request_id for request_id in request_ids])
+
+    def test_max_connections(self):
+        os.environ['AWS_LAMBDA_FUNCTION_MEMORY_SIZE'] = "1536"
+        try:
+            self.assertEqual(12, scarsupervisor.get_max_connections())
+            os.environ['RECORDS_MODE'] = "concurrent"
+            self.assertEqual(12 * scarsupervisor.get_max_records(), scarsupervisor.get_max_connections())
+        finally:
+            del os.environ['AWS_LAMBDA_FUNCTION_MEMORY_SIZE']
+            os.environ.pop('RECORDS_MODE', None)
+
+    def test_max_workers(self):
+        os.environ['AWS_LAMBDA_FUNCTION_MEMORY_SIZE'] = "128"
+        self.assertEqual(2, scarsupervisor.get_max_workers())
+        os.environ['AWS_LAMBDA_FUNCTION_MEMORY_SIZE'] = "1536"
+        self.assertEqual(12, scarsupervisor.get_max_workers())
+        del os.environ['AWS_LAMBDA_FUNCTION_MEMORY_SIZE']
+
+    def test_records_mode(self):
+        event = {'Records' : [{'eventSource' : 'aws:s3', 's3' : {}}, {'eventSource' : 'aws:s3', 's3' : {}}]}
+        self.assertFalse(scarsupervisor.is_records_mode(event))
+        os.environ['RECORDS_MODE'] = "concurrent"
+        try:
+            self.assertTrue(scarsupervisor.is_records_mode(event))
+            self.assertFalse(scarsupervisor.is_records_mode({'Records' : event['Records'][:1]}))
+            self.assertFalse(scarsupervisor.is_records_mode({'script' : 'echo'}))
+        finally:
+            del os.environ['RECORDS_MODE']
+
+    def test_process_records_keep_event(self):
+        event = {'cmd_args' : ['-i', 'input'], 'env' : {'MODE' : 'fast'},
+                 'Records' : [{'eventSource' : 'aws:s3', 's3' : {'bucket' : {'name' : 'bucket-a'},
+                                                                  'object' : {'key' : 'input/%s.txt' % name}}}
+                              for name in ("a", "b")]}
+        environ = dict(os.environ)
+        os.environ.update({'UDOCKER_DIR' : self.tmp_dir.name, 'AWS_ACCESS_KEY_ID' : 'key',
+                           'AWS_SECRET_ACCESS_KEY' : 'secret', 'AWS_SESSION_TOKEN' : 'token',
+                           'AWS_SECURITY_TOKEN' : 'token'})
+        scarsupervisor.S3_Bucket.client = FakeS3Client()
+        scarsupervisor.metrics = scarsupervisor.Metrics(False)
+        scarsupervisor.udocker_api = FakeUdocker()
+        try:
+            output = scarsupervisor.process_records(event, FakeContext(300000))
+        finally:
+            os.environ.clear()
+            os.environ.update(environ)
+            scarsupervisor.S3_Bucket.client = None
+            scarsupervisor.udocker_api = None
+            scarsupervisor.call(["rm", "-rf", "/tmp/request-id-0", "/tmp/request-id-1"])
+        self.assertEqual(2, output.count("MODE=fast lambda_cont -i input\n"))
+        self.assertIn("with key input/a.txt (Request Id: request-id-0)", output)
+        self.assertIn("with key input/b.txt (Request Id: request-id-1)", output)
+
+    def test_handler_without_image_id(self):
+        context = FakeContext(300000)
+        context.log_group_name = "log-group"
+        context.log_stream_name = "log-stream"
+        environ = dict(os.environ)
+        os.environ.pop('IMAGE_ID', None)
+        try:
+            output = scarsupervisor.lambda_handler({}, context)
+        finally:
+            os.environ.clear()
+            os.environ.update(environ)
+            scarsupervisor.call(["rm", "-rf", "/tmp/request-id"])
+        self.assertIn("ERROR: Exception launched:", output)
+        self.assertIn("KeyError: 'IMAGE_ID'", output)
+        self.assertIn("SCAR: Metrics:", output)
+
+    def test_container_timeout(self):
+        # The threshold and the stop grace period are left for the upload
+        self.assertEqual(288, scarsupervisor.get_container_timeout(FakeContext(300000)))
+        # Functions with a timeout below the threshold keep 10% of their time
+        self.assertAlmostEqual(2.5, scarsupervisor.get_container_timeout(FakeContext(5000)))
+        self.assertAlmostEqual(7, scarsupervisor.get_container_timeout(FakeContext(10000)))
+        self.assertEqual(0, scarsupervisor.get_container_timeout(FakeContext(2000)))
+        # Without time left the watchdog stops the container right away
+        self.assertEqual(0, scarsupervisor.get_container_timeout(FakeContext(0)))
+        self.assertEqual(0, scarsupervisor.get_container_timeout(FakeContext(-500)))
+        self.assertEqual(None, scarsupervisor.get_container_timeout(object()))
+
+    def test_container_watchdog(self):
+        watchdog = scarsupervisor.ContainerWatchdog(0.2)
+        output = scarsupervisor.execute_command(["sh", "-c", "echo start; sleep 10; echo end"], watchdog=watchdog)
+        self.assertTrue(watchdog.stopped)
+        self.assertEqual("start\nSCAR: Container stopped before the function timeout, the output is truncated\n", output)
+        watchdog = scarsupervisor.ContainerWatchdog(10)
+        self.assertEqual("end\n", scarsupervisor.execute_command(["echo", "end"], watchdog=watchdog))
+        self.assertFalse(watchdog.stopped)
+        # Without time left the container is not run
+        watchdog = scarsupervisor.ContainerWatchdog(scarsupervisor.get_container_timeout(FakeContext(0)))
+        output = scarsupervisor.execute_command(["echo", "end"], watchdog=watchdog)
+        self.assertTrue(watchdog.stopped)
+        self.assertTrue(output.startswith("SCAR: Not enough time left"))
+
+    def test_input_streamer(self):
+        request_id = str(uuid.uuid4())
+        records = [{'bucket' : {'name' : 'bucket-a'}, 'object' : {'key' : 'input/a.txt'}},
+                   {'bucket' : {'name' : 'bucket-a'}, 'object' : {'key' : 'input/b.txt'}}]
+        scarsupervisor.S3_Bucket.client = FakeS3Client()
+        scarsupervisor.metrics = scarsupervisor.Metrics(False)
+        try:
+            # Only the first input is read by the container
+            streamer = scarsupervisor.InputStreamer(records, request_id, "fifo")
+            output = scarsupervisor.execute_command(["cat", "/tmp/%s/input/a.txt" % request_id],
+                                                    input_streamer=streamer)
+            self.assertEqual("bucket-a/input/a.txt", output)
+            self.assertFalse(os.path.exists("/tmp/%s/input/a.txt" % request_id))
+            streamer = scarsupervisor.InputStreamer(records, request_id, "stdin")
+            output = scarsupervisor.execute_command(["cat"], input_streamer=streamer)
+            self.assertEqual("bucket-a/input/a.txtbucket-a/input/b.txt", output)
+        finally:
+            scarsupervisor.S3_Bucket.client = None
+            scarsupervisor.call(["rm", "-rf", "/tmp/%s" % request_id])
+
+    def test_upload_outputs_to_each_bucket(self):
+        request_id = str(uuid.uuid4())
+        output_folder = "/tmp/%s/output/" % request_id
+        os.makedirs(output_folder + "frames")
+        scarsupervisor.create_file("data", output_folder + "frames/0001.png")
+        client = FakeS3Client()
+        scarsupervisor.S3_Bucket.client = client
+        records = [{'bucket' : {'name' : 'bucket-a'}}, {'bucket' : {'name' : 'bucket-b'}},
+                   {'bucket' : {'name' : 'bucket-a'}}]
+        try:
+            scarsupervisor.S3_Bucket().upload_outputs(records, request_id)
+        finally:
+            scarsupervisor.S3_Bucket.client = None
+            scarsupervisor.call(["rm", "-rf", "/tmp/%s" % request_id])
+        self.assertEqual(sorted(client.uploads),
+                         [('bucket-a', 'output/frames/0001.png', {'ACL' : 'public-read'}),
+                          ('bucket-b', 'output/frames/0001.png', {'ACL' : 'public-read'})])
+
+    def test_output_buffer(self):
+        output = scarsupervisor.OutputBuffer(10)
+        output.append(b"1234\n")
+        output.append(b"5678\n")
+        self.assertEqual("1234\n5678\n", output.getvalue())
+        output.append(b"90\n")
+        self.assertEqual("SCAR: Output truncated, showing the last 8 bytes\n5678\n90\n", output.getvalue())
+        output.append(b"abcdefghijkl\n")
+        self.assertEqual("SCAR: Output truncated, showing the last 10 bytes\ndefghijkl\n", output.getvalue())
+
+    def test_execute_command(self):
+        os.environ['MAX_OUTPUT_SIZE'] = "4"
+        try:
+            self.assertTrue(scarsupervisor.execute_command(["echo", "hello"]).endswith("llo\n"))
+        finally:
+            del os.environ['MAX_OUTPUT_SIZE']
+        self.assertEqual("hello\n", scarsupervisor.execute_command(["echo", "hello"]))
+
+    def test_embedded_metrics(self):
+        metrics = scarsupervisor.Metrics(True)
+        with metrics.phase("Run"):
+            pass
+        metrics.add_bytes("Download", 10)
+        metrics.add_bytes("Download", 5)
+        values = metrics.get_embedded_metrics()
+        self.assertTrue(values["ColdStart"])
+        self.assertEqual(15, values["DownloadBytes"])
+        self.assertTrue("RunTime" in values)
+        self.assertEqual([{"Name" : "RunTime", "Unit" : "Milliseconds"}, {"Name" : "DownloadBytes", "Unit" : "Bytes"}],
+                         values["_aws"]["CloudWatchMetrics"][0]["Metrics"])
+
+    def test_metrics_concurrent_phases(self):
+        metrics = scarsupervisor.Metrics(False)
+        def run():
+            with metrics.phase("Run"):
+                time.sleep(0.2)
+        threads = [threading.Thread(target=run) for dummy in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # The runs overlap, their time is not added up
+        self.assertGreaterEqual(metrics.times["Run"], 200)
+        self.assertLess(metrics.times["Run"], 400)
+
+    def test_tmp_space_manager(self):
+        tmp_dir = self.tmp_dir.name
+        udocker_dir = os.path.join(tmp_dir, "home", ".udocker")
+        layers_dir = os.path.join(udocker_dir, "layers")
+        containers_dir = os.path.join(udocker_dir, "containers")
+        os.makedirs(layers_dir)
+        os.makedirs(containers_dir)
+        for request_id in ["old", "current"]:
+            os.makedirs(os.path.join(tmp_dir, request_id))
+            scarsupervisor.create_file("{}", os.path.join(tmp_dir, request_id, "event.json"))
+        for image_dir, layer in [("ubuntu/16.04", "sha256:1"), ("centos/7", "sha256:2")]:
+            os.makedirs(os.path.join(udocker_dir, "repos", image_dir))
+            scarsupervisor.create_file(image_dir, os.path.join(udocker_dir, "repos", image_dir, "TAG"))
+            scarsupervisor.create_file("layer", os.path.join(layers_dir, layer))
+            os.symlink(os.path.join(layers_dir, layer), os.path.join(udocker_dir, "repos", image_dir, layer))
+        for container_id in ["id-1", "id-2"]:
+            os.makedirs(os.path.join(containers_dir, container_id, "ROOT"))
+        os.symlink("id-1", os.path.join(containers_dir, "lambda_cont"))
+        os.symlink("id-2", os.path.join(containers_dir, "other_cont"))
+        # Container files are hard links to the extracted image trees
+        for tree, container_id in [("tree-1", "id-1"), ("tree-2", "id-2")]:
+            os.makedirs(os.path.join(udocker_dir, "trees", tree))
+            scarsupervisor.create_file("x" * 1000, os.path.join(udocker_dir, "trees", tree, "file"))
+            os.link(os.path.join(udocker_dir, "trees", tree, "file"),
+                    os.path.join(containers_dir, container_id, "ROOT", "file"))
+
+        manager = scarsupervisor.TmpSpaceManager("current", "ubuntu:16.04", tmp_dir, udocker_dir)
+        trees = manager.get_trees()
+        self.assertEqual(2, len(trees))
+        # The file is still linked from the container, removing the tree frees nothing
+        self.assertEqual(os.lstat(trees[0][0]).st_size, manager.get_size(trees[0]))
+        self.assertEqual(1000, manager.get_size([os.path.join(udocker_dir, "trees", "tree-1", "file"),
+                                                 os.path.join(containers_dir, "id-1", "ROOT", "file")]))
+        # Nothing but the protected files fits in the limit
+        manager.get_used_space = lambda: 0
+        scarsupervisor.udocker_api = FakeUdocker()
+        try:
+            manager.free_space(-1024 * 1024)
+            # The repository index is rebuilt once after the eviction
+            self.assertEqual([("refresh", True)], scarsupervisor.udocker_api.calls)
+        finally:
+            scarsupervisor.udocker_api = None
+
+        remaining = sorted(os.path.relpath(os.path.join(dirname, name), tmp_dir)
+                           for dirname, dirnames, filenames in os.walk(tmp_dir) for name in filenames)
+        self.assertEqual(["current/event.json", "home/.udocker/containers/id-1/ROOT/file",
+                          "home/.udocker/layers/sha256:1",
+                          "home/.udocker/repos/ubuntu/16.04/TAG", "home/.udocker/repos/ubuntu/16.04/sha256:1"],
+                         remaining)
+        self.assertFalse(os.listdir(os.path.join(udocker_dir, "trees")))
+        self.assertTrue(os.path.isdir(os.path.join(containers_dir, "lambda_cont", "ROOT")))
+        self.assertFalse(os.path.lexists(os.path.join(containers_dir, "other_cont")))
+        self.assertFalse(os.path.exists(os.path.join(containers_dir, "id-2")))
+
+if __name__ == '__main__':
+    unittest.main()
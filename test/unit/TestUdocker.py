@@ -0,0 +1,763 @@
+import unittest
+import fcntl
+import hashlib
+import imp
+import io
+import json
+import os
+import shutil
+import struct
+import tarfile
+import tempfile
+
+udocker = imp.load_source("udocker", os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                                  "..", "..", "lambda", "udocker"))
+
+def make_layer(files):
+    buf = io.BytesIO()
+    tar = tarfile.open(fileobj=buf, mode="w:gz")
+    for name, data in files:
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        tar.addfile(info, io.BytesIO(data))
+    tar.close()
+    return buf.getvalue()
+
+def write_file(filename, data):
+    with open(filename, "wb") as filep:
+        filep.write(data)
+
+def make_elf(bits, segments):
+    """Little-endian ELF file with the (p_type, data) segments"""
+    if bits == 64:
+        (header_size, ph_format) = (64, "<IIQQQQQQ")
+    else:
+        (header_size, ph_format) = (52, "<IIIIIIII")
+    ph_size = struct.calcsize(ph_format)
+    offset = header_size + ph_size * len(segments)
+    (ph_table, data) = (b"", b"")
+    for (p_type, p_data) in segments:
+        if bits == 64:
+            ph_table += struct.pack(ph_format, p_type, 0, offset + len(data), 0, 0, len(p_data), len(p_data), 0)
+        else:
+            ph_table += struct.pack(ph_format, p_type, offset + len(data), 0, 0, len(p_data), len(p_data), 0, 0)
+        data += p_data
+    ident = b"\x7fELF" + struct.pack("BBB", 2 if bits == 64 else 1, 1, 1) + b"\x00" * 9
+    if bits == 64:
+        header = ident + struct.pack("<HHIQQQIHHHHHH", 2, 62, 1, 0, header_size, 0, 0,
+                                     header_size, ph_size, len(segments), 0, 0, 0)
+    else:
+        header = ident + struct.pack("<HHIIIIIHHHHHH", 2, 3, 1, 0, header_size, 0, 0,
+                                     header_size, ph_size, len(segments), 0, 0, 0)
+    return header + ph_table + data
+
+class RepositoryTestCase(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        udocker.Msg().setlevel(udocker.Msg.ERR - 1)  # quiet the expected errors
+
+    def setUp(self):
+        self.top_dir = tempfile.mkdtemp()
+        self.repo = udocker.LocalRepository(self.top_dir)
+        self.repo.create_repo()
+
+    def tearDown(self):
+        udocker.ChkSUM().set_index(None)
+        for dir_path, dummy, dummy in os.walk(self.top_dir):
+            os.chmod(dir_path, 0o700)
+        shutil.rmtree(self.top_dir)
+
+    def add_image(self, imagerepo, tag, layers):
+        """Add a v2 image as pulled, returns the layer files"""
+        self.repo.setup_imagerepo(imagerepo)
+        self.repo.setup_tag(tag)
+        self.repo.set_version("v2")
+        layer_ids = ["sha256:" + hashlib.sha256(data).hexdigest() for data in layers]
+        manifest = {"fsLayers": [{"blobSum": layer_id} for layer_id in reversed(layer_ids)],
+                    "history": [{"v1Compatibility": json.dumps({"id": "1", "config": {}})}]}
+        self.repo.save_json("manifest", manifest)
+        filenames = []
+        for (layer_id, data) in zip(layer_ids, layers):
+            filename = os.path.join(self.repo.layersdir, layer_id)
+            write_file(filename, data)
+            self.repo.add_image_layer(filename)
+            filenames.append(filename)
+        return filenames
+
+class TestChkSUM(RepositoryTestCase):
+
+    def setUp(self):
+        RepositoryTestCase.setUp(self)
+        self.filename = os.path.join(self.repo.layersdir, "sha256:file")
+        self.hashed = []
+        self.sha256_call = udocker.ChkSUM._hashlib_sha256
+
+        def counted_sha256(chksum, filename):
+            self.hashed.append(filename)
+            return self.sha256_call(chksum, filename)
+        udocker.ChkSUM._hashlib_sha256 = counted_sha256
+
+    def tearDown(self):
+        udocker.ChkSUM._hashlib_sha256 = self.sha256_call
+        RepositoryTestCase.tearDown(self)
+
+    def new_process(self):
+        udocker.ChkSUM._index = None
+
+    def test_digest_remembered(self):
+        write_file(self.filename, b"data")
+        digest = hashlib.sha256(b"data").hexdigest()
+        self.assertEqual(digest, udocker.ChkSUM().sha256(self.filename))
+        udocker.ChkSUM().save_index()
+        self.new_process()
+        self.assertEqual(digest, udocker.ChkSUM().sha256(self.filename))
+        self.assertEqual(1, len(self.hashed))
+
+    def test_stale_entry_after_rewrite(self):
+        write_file(self.filename, b"data")
+        udocker.ChkSUM().sha256(self.filename)
+        udocker.ChkSUM().save_index()
+        # same size and inode, only the mtime tells that it changed
+        mtime = os.stat(self.filename).st_mtime
+        write_file(self.filename, b"DATA")
+        os.utime(self.filename, (mtime + 10, mtime + 10))
+        self.new_process()
+        self.assertEqual(hashlib.sha256(b"DATA").hexdigest(), udocker.ChkSUM().sha256(self.filename))
+        self.assertEqual(2, len(self.hashed))
+
+    def test_saved_once_and_merged(self):
+        write_file(self.filename, b"data")
+        udocker.ChkSUM().sha256(self.filename)
+        index_file = os.path.join(self.repo.layersdir, ".digests")
+        self.assertFalse(os.path.exists(index_file))
+        # the entries saved meanwhile by other processes are kept
+        other = os.path.join(self.repo.layersdir, "sha256:other")
+        write_file(other, b"other")
+        write_file(index_file, json.dumps({other: [5, 0, 0, "digest"],
+                                           "/missing": [1, 0, 0, "digest"]}).encode())
+        udocker.ChkSUM().save_index()
+        with open(index_file) as filep:
+            self.assertEqual(sorted([other, os.path.realpath(self.filename)]), sorted(json.load(filep)))
+
+    def test_verify_skips_tar_listing(self):
+        layer_files = self.add_image("test/img", "latest", [make_layer([("etc/a", b"a")]),
+                                                            make_layer([("etc/b", b"b")])])
+        verify_tar = udocker.FileUtil.verify_tar
+        listed = []
+        udocker.FileUtil.verify_tar = lambda fileutil: listed.append(fileutil.filename)
+        try:
+            self.assertTrue(self.repo.verify_image())
+            self.assertEqual([], listed)
+            self.assertEqual(2, len(self.hashed))
+            self.assertTrue(self.repo.verify_image())
+            self.assertEqual(2, len(self.hashed))   # the digests were remembered
+            with open(layer_files[1], "ab") as filep:
+                filep.write(b"x")
+            self.assertFalse(self.repo.verify_image())
+        finally:
+            udocker.FileUtil.verify_tar = verify_tar
+
+class TestLocalRepositoryIndex(RepositoryTestCase):
+
+    def setUp(self):
+        RepositoryTestCase.setUp(self)
+        self.layer_files = self.add_image("test/img", "latest", [make_layer([("etc/a", b"a")])])
+        self.repo.setup_container("test/img", "latest", "c1")
+        self.repo.setup_container("test/img", "latest", "c2")
+        self.repo.set_container_name("c2", "web")
+
+    def reopened(self):
+        """A repository object of another udocker invocation"""
+        return udocker.LocalRepository(self.top_dir)
+
+    def load_index(self):
+        with open(self.repo.index_file) as filep:
+            return json.load(filep)
+
+    def test_missing_index_rebuilt(self):
+        index = self.load_index()
+        os.remove(self.repo.index_file)
+        repo = self.reopened()
+        self.assertFalse(repo.check_index())
+        self.assertEqual(index, self.load_index())
+        self.assertTrue(self.reopened().check_index())
+        os.remove(self.repo.index_file)
+        self.assertEqual([("test/img", "latest")], self.reopened().get_imagerepos())
+        self.assertEqual(index, self.load_index())
+
+    def test_invalid_index_rebuilt(self):
+        write_file(self.repo.index_file, b'{"images": []}')
+        self.assertFalse(self.reopened().check_index())
+        self.assertEqual(["c1", "c2"], sorted(self.load_index()["containers"]))
+
+    def test_stale_container_pruned(self):
+        shutil.rmtree(os.path.join(self.repo.containersdir, "c2"))
+        repo = self.reopened()
+        self.assertEqual([os.path.join(self.repo.containersdir, "c1")], repo.get_containers_list())
+        index = self.load_index()
+        self.assertEqual(["c1"], list(index["containers"]))
+        self.assertEqual({}, index["names"])
+
+    def test_stale_image_pruned(self):
+        shutil.rmtree(os.path.join(self.repo.reposdir, "test"))
+        self.assertEqual([], self.reopened().get_imagerepos())
+        index = self.load_index()
+        self.assertEqual({}, index["images"])
+        self.assertEqual({}, index["layers"])
+        self.assertTrue(self.reopened().check_index())
+
+    def test_cd_container_rejects_paths(self):
+        for container_id in ("", "/", ".", "..", "c1/ROOT", "../containers/c1"):
+            self.assertEqual("", self.repo.cd_container(container_id))
+        self.assertFalse(self.repo.del_container("."))
+        self.assertEqual(["c1", "c2", "web"], sorted(os.listdir(self.repo.containersdir)))
+        self.assertEqual(os.path.join(self.repo.containersdir, "c1"), self.repo.cd_container("c1"))
+
+class TestRunCache(RepositoryTestCase):
+
+    def setUp(self):
+        RepositoryTestCase.setUp(self)
+        self.container_dir = self.repo.setup_container("test/img", "latest", "c1")
+        write_file(os.path.join(self.container_dir, "container.json"),
+                   json.dumps({"config": {"Env": ["A=1"], "Volumes": ["/data"]}}).encode())
+        self.computed = []
+
+    def compute(self, value):
+        self.computed.append(value)
+        return value
+
+    def cached(self, value):
+        """Get the value through the cache of a new udocker invocation"""
+        return udocker._RunCache(self.repo, self.container_dir).get("name", self.compute, value)
+
+    def touch(self, filename):
+        """Create or change the file so that its mtime differs"""
+        filename = os.path.join(self.container_dir, filename)
+        with open(filename, "ab") as filep:
+            filep.write(b"x")
+        mtime = os.stat(filename).st_mtime + 10
+        os.utime(filename, (mtime, mtime))
+
+    def test_value_cached(self):
+        self.assertEqual(["a"], self.cached(["a"]))
+        self.assertEqual(["a"], self.cached(["b"]))
+        self.assertEqual([["a"]], self.computed)
+
+    def test_none_not_cached(self):
+        self.assertIsNone(self.cached(None))
+        self.assertEqual("a", self.cached("a"))
+        self.assertEqual([None, "a"], self.computed)
+
+    def test_invalidated_by_container_files(self):
+        self.cached(0)
+        for (count, filename) in enumerate(("container.json", "execmode", "patch.path", "patch.time"), 1):
+            self.touch(filename)
+            self.assertEqual(count, self.cached(count), filename)
+            self.assertEqual(count, self.cached(-1), filename)
+        self.assertEqual([0, 1, 2, 3, 4], self.computed)
+
+    def test_metadata_not_mutated(self):
+        for env in (["B=2"], ["C=3"]):
+            engine = udocker.ExecutionEngineCommon(self.repo)
+            engine.opt["env"] = list(env)
+            (container_dir, metadata) = engine._run_load_metadata("c1")
+            self.assertEqual(self.container_dir, container_dir)
+            self.assertEqual(["A=1"] + env, engine.opt["env"])
+            self.assertEqual(["/data"], engine.opt["vol"])
+        engine.opt["vol"].append("/tmp")
+        metadata = engine._run_cache.get("metadata", None)
+        self.assertEqual(["A=1"], metadata["Env"])
+        self.assertEqual(["/data"], metadata["Volumes"])
+
+    def test_create_user_keeps_umask(self):
+        (passwd, group) = (os.path.join(self.top_dir, "passwd"), os.path.join(self.top_dir, "group"))
+        write_file(passwd, b"root:x:0:0:root:/root:/bin/sh\n")
+        write_file(group, b"root:x:0:\n")
+        engine = udocker.ExecutionEngineCommon(self.repo)
+        engine.opt.update(dict.fromkeys(("user", "uid", "gid", "home", "gecos", "shell"), ""))
+        umasks = []
+        copyto = udocker.FileUtil.copyto
+
+        def copyto_umask(self, *args, **kwargs):
+            umasks.append(os.umask(0o027))
+            os.umask(umasks[-1])
+            return copyto(self, *args, **kwargs)
+        old_umask = os.umask(0o027)
+        udocker.FileUtil.copyto = copyto_umask
+        try:
+            self.assertTrue(engine._create_user(udocker.NixAuthentication(passwd, group),
+                                                udocker.NixAuthentication()))
+            self.assertEqual(0o027, os.umask(0o027))
+        finally:
+            udocker.FileUtil.copyto = copyto
+            os.umask(old_umask)
+        # the umask is shared by the threads of the supervisor
+        self.assertEqual([0o027, 0o027], umasks)
+        for filename in [auth_file.split(":")[0] for auth_file in engine.hostauth_list]:
+            self.assertEqual(0o600, os.stat(filename).st_mode & 0o777)
+            os.remove(filename)
+
+class TestElfPatcher(RepositoryTestCase):
+
+    PT_LOAD = 1
+    PT_DYNAMIC = 2
+    PT_INTERP = 3
+
+    def setUp(self):
+        RepositoryTestCase.setUp(self)
+        self.container_dir = self.repo.setup_container("test/img", "latest", "c1")
+        self.root = os.path.join(self.container_dir, "ROOT")
+        self.patcher = udocker.ElfPatcher(self.repo, "c1")
+
+    def add_file(self, name, data, mode=0o644):
+        filename = os.path.join(self.root, name)
+        if not os.path.isdir(os.path.dirname(filename)):
+            os.makedirs(os.path.dirname(filename))
+        write_file(filename, data)
+        os.chmod(filename, mode)
+        return filename
+
+    def interp(self, data):
+        return self.patcher._read_elf_interp(self.add_file("file", data))
+
+    def test_interp_64_bit(self):
+        self.assertEqual("/lib64/ld-linux-x86-64.so.2", self.interp(make_elf(64, [
+            (self.PT_LOAD, b""), (self.PT_INTERP, b"/lib64/ld-linux-x86-64.so.2\x00"), (self.PT_DYNAMIC, b"")])))
+
+    def test_interp_32_bit(self):
+        self.assertEqual("/lib/ld-linux.so.2", self.interp(make_elf(32, [
+            (self.PT_INTERP, b"/lib/ld-linux.so.2\x00"), (self.PT_DYNAMIC, b"")])))
+
+    def test_shared_library(self):
+        self.assertEqual("", self.interp(make_elf(64, [(self.PT_LOAD, b""), (self.PT_DYNAMIC, b"")])))
+        self.assertEqual("", self.interp(make_elf(32, [(self.PT_DYNAMIC, b"")])))
+
+    def test_static_binary(self):
+        self.assertIsNone(self.interp(make_elf(64, [(self.PT_LOAD, b"code")])))
+
+    def test_not_elf(self):
+        self.assertIsNone(self.interp(b"#!/bin/sh\necho hello\n" * 4))
+        self.assertIsNone(self.interp(b""))
+
+    def test_truncated_header(self):
+        self.assertIsNone(self.interp(make_elf(64, [(self.PT_INTERP, b"/lib/ld.so\x00")])[:40]))
+        # the program headers are missing
+        self.assertIsNone(self.interp(make_elf(64, [(self.PT_INTERP, b"/lib/ld.so\x00")])[:64]))
+
+    def test_elf_files_kept(self):
+        self.add_file("bin/app", make_elf(64, [(self.PT_INTERP, b"/lib/ld.so\x00")]), 0o755)
+        self.add_file("lib/libx.so.1", make_elf(64, [(self.PT_DYNAMIC, b"")]))
+        self.add_file("bin/static", make_elf(64, [(self.PT_LOAD, b"")]), 0o755)
+        self.add_file("bin/script", b"#!/bin/sh\n" * 8, 0o755)
+        self.add_file("share/data", make_elf(64, [(self.PT_INTERP, b"/lib/ld.so\x00")]))
+        elf_files = [os.path.join(self.root, name) for name in ("bin/app", "lib/libx.so.1")]
+        self.assertEqual(elf_files, sorted(self.patcher.get_elf_files()))
+        self.add_file("bin/new", make_elf(32, [(self.PT_INTERP, b"/lib/ld.so\x00")]), 0o755)
+        # the list is searched again only when forced
+        self.assertEqual(elf_files, sorted(self.patcher.get_elf_files()))
+        self.assertEqual(sorted(elf_files + [os.path.join(self.root, "bin/new")]),
+                         sorted(self.patcher.get_elf_files(force=True)))
+
+    def test_shared_files_unshared_before_patching(self):
+        shared_dir = os.path.join(self.top_dir, "tree")
+        os.makedirs(shared_dir)
+        elf_files = []
+        for index in range(8):
+            shared = os.path.join(shared_dir, "app%d" % index)
+            write_file(shared, b"original")
+            os.chmod(shared, 0o555)
+            elf_files.append(os.path.join(self.root, "app%d" % index))
+            os.link(shared, elf_files[-1])
+        self.patcher._run_patchelf("echo patched >> #f", elf_files)
+        for (index, f_path) in enumerate(elf_files):
+            with open(f_path, "rb") as filep:
+                self.assertEqual(b"originalpatched\n", filep.read())
+            self.assertEqual(1, os.stat(f_path).st_nlink)
+            with open(os.path.join(shared_dir, "app%d" % index), "rb") as filep:
+                self.assertEqual(b"original", filep.read())
+
+class FakeS3Client(object):
+    """S3 client of the layer cache, objects kept in a dict"""
+
+    def __init__(self, objects=None):
+        self.objects = dict(objects or {})
+        self.puts = []
+
+    def download_file(self, bucket, key, filename):
+        if (bucket, key) not in self.objects:
+            raise IOError("Not Found")
+        write_file(filename, self.objects[(bucket, key)])
+
+    def upload_file(self, filename, bucket, key):
+        with open(filename, "rb") as filep:
+            self.objects[(bucket, key)] = filep.read()
+        self.puts.append(key)
+
+class FakeBoto3(object):
+
+    def __init__(self, s3_client):
+        self.s3_client = s3_client
+
+    def client(self, service):
+        return self.s3_client if service == "s3" else None
+
+class TestLayerCache(RepositoryTestCase):
+
+    def setUp(self):
+        RepositoryTestCase.setUp(self)
+        self.layer = make_layer([("etc/a", b"a")])
+        self.layer_id = "sha256:" + hashlib.sha256(self.layer).hexdigest()
+        self.filename = os.path.join(self.repo.layersdir, self.layer_id)
+        self.boto3 = udocker.LayerCache._boto3
+        self.registry_gets = []
+        self.api = udocker.DockerIoAPI(self.repo)
+        self.api.layer_cache = udocker.LayerCache("s3://layers/cache")
+        self.api._get_url = self.registry_get
+
+    def tearDown(self):
+        udocker.LayerCache._boto3 = self.boto3
+        RepositoryTestCase.tearDown(self)
+
+    def registry_get(self, url, ofile=None, resume=False):
+        """Download of the layer from the registry"""
+        self.registry_gets.append(url)
+        write_file(ofile, self.layer)
+        hdr = udocker.CurlHeader()
+        hdr.data["content-length"] = str(len(self.layer))
+        hdr.data["X-ND-CURLSTATUS"] = 0
+        return (hdr, "")
+
+    def get_file(self, objects=None):
+        s3_client = FakeS3Client(objects)
+        udocker.LayerCache._boto3 = FakeBoto3(s3_client)
+        self.assertTrue(self.api._get_file("https://registry/v2/test/img/blobs/" + self.layer_id,
+                                           self.filename, 3))
+        with open(self.filename, "rb") as filep:
+            self.assertEqual(self.layer, filep.read())
+        self.assertFalse(os.path.exists(self.filename + ".cache"))
+        return s3_client
+
+    def test_miss_then_put(self):
+        s3_client = self.get_file()
+        self.assertEqual(1, len(self.registry_gets))
+        self.assertEqual(["cache/" + self.layer_id], s3_client.puts)
+        self.assertEqual(self.layer, s3_client.objects[("layers", "cache/" + self.layer_id)])
+
+    def test_hit_verified(self):
+        s3_client = self.get_file({("layers", "cache/" + self.layer_id): self.layer})
+        self.assertEqual([], self.registry_gets)
+        self.assertEqual([], s3_client.puts)
+
+    def test_corrupt_object_fetched_from_registry(self):
+        s3_client = self.get_file({("layers", "cache/" + self.layer_id): b"corrupt"})
+        self.assertEqual(1, len(self.registry_gets))
+        # the verified layer replaces the corrupt one in the cache
+        self.assertEqual(self.layer, s3_client.objects[("layers", "cache/" + self.layer_id)])
+
+    def test_not_available(self):
+        udocker.LayerCache._boto3 = False
+        self.assertFalse(udocker.LayerCache("s3://layers").is_available())
+        udocker.LayerCache._boto3 = FakeBoto3(FakeS3Client())
+        self.assertFalse(udocker.LayerCache("").is_available())
+        self.assertTrue(udocker.LayerCache("s3://layers").is_available())
+
+class TestLayerExtractor(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        udocker.Msg().setlevel(udocker.Msg.ERR - 1)  # quiet the expected errors
+
+    def setUp(self):
+        self.tmp_dir = os.path.realpath(tempfile.mkdtemp())
+        self.root = os.path.join(self.tmp_dir, "ROOT")
+        self.outside = os.path.join(self.tmp_dir, "outside")
+        os.makedirs(self.root)
+        os.makedirs(os.path.join(self.outside, "dir"))
+        write_file(os.path.join(self.outside, "file"), b"outside")
+        write_file(os.path.join(self.outside, "dir", "file"), b"outside")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def extract(self, entries):
+        """Extract a layer of (name, type, data or link name) entries"""
+        buf = io.BytesIO()
+        tar = tarfile.open(fileobj=buf, mode="w")
+        for (name, member_type, data) in entries:
+            info = tarfile.TarInfo(name)
+            info.type = member_type
+            if member_type in (tarfile.SYMTYPE, tarfile.LNKTYPE):
+                info.linkname = data
+            elif member_type == tarfile.DIRTYPE:
+                info.mode = 0o755
+            else:
+                info.size = len(data)
+            tar.addfile(info, io.BytesIO(data) if member_type == tarfile.REGTYPE else None)
+        tar.close()
+        buf.seek(0)
+        return udocker._LayerExtractor(self.root).extract(buf)
+
+    def files(self, top):
+        found = []
+        for dir_path, dir_names, file_names in os.walk(top):
+            found.extend(os.path.relpath(os.path.join(dir_path, name), top) for name in dir_names + file_names)
+        return sorted(found)
+
+    def assert_outside_untouched(self):
+        self.assertEqual(["dir", "dir/file", "file"], self.files(self.outside))
+
+    def test_whiteout(self):
+        self.assertTrue(self.extract([("etc", tarfile.DIRTYPE, b""), ("etc/a", tarfile.REGTYPE, b"a"),
+                                      ("etc/b", tarfile.REGTYPE, b"b"), ("usr/x", tarfile.REGTYPE, b"x")]))
+        self.assertTrue(self.extract([("etc/.wh.a", tarfile.REGTYPE, b""), (".wh.usr", tarfile.REGTYPE, b""),
+                                      ("etc/c", tarfile.REGTYPE, b"c")]))
+        self.assertEqual(["etc", "etc/b", "etc/c"], self.files(self.root))
+
+    def test_opaque_dir(self):
+        self.assertTrue(self.extract([("etc/a", tarfile.REGTYPE, b"a"), ("etc/sub/b", tarfile.REGTYPE, b"b"),
+                                      ("usr/x", tarfile.REGTYPE, b"x")]))
+        # the entries of the same layer are kept, whatever their order
+        self.assertTrue(self.extract([("etc/c", tarfile.REGTYPE, b"c"), ("etc/.wh..wh..opq", tarfile.REGTYPE, b""),
+                                      ("etc/sub/d", tarfile.REGTYPE, b"d")]))
+        self.assertEqual(["etc", "etc/c", "etc/sub", "etc/sub/d", "usr", "usr/x"], self.files(self.root))
+
+    def test_absolute_and_parent_names(self):
+        self.assertTrue(self.extract([("/etc/a", tarfile.REGTYPE, b"a"), ("../outside/new", tarfile.REGTYPE, b"x"),
+                                      ("etc/../../outside/new", tarfile.REGTYPE, b"x")]))
+        self.assertEqual(["etc", "etc/a"], self.files(self.root))
+        self.assert_outside_untouched()
+
+    def test_symlink_escape_refused(self):
+        self.assertFalse(self.extract([("esc", tarfile.SYMTYPE, self.outside),
+                                       ("esc/new", tarfile.REGTYPE, b"x"),
+                                       ("esc/.wh.file", tarfile.REGTYPE, b""),
+                                       ("esc/dir/.wh..wh..opq", tarfile.REGTYPE, b""),
+                                       ("link", tarfile.SYMTYPE, os.path.join(self.outside, "file")),
+                                       ("hard", tarfile.LNKTYPE, "link"),
+                                       ("rel", tarfile.SYMTYPE, "../outside"),
+                                       ("rel/file", tarfile.REGTYPE, b"x")]))
+        self.assert_outside_untouched()
+        with open(os.path.join(self.outside, "file"), "rb") as filep:
+            self.assertEqual(b"outside", filep.read())
+        self.assertEqual(["esc", "link", "rel"], sorted(os.listdir(self.root)))
+
+    def test_whiteout_of_symlink_removes_the_link(self):
+        self.assertTrue(self.extract([("esc", tarfile.SYMTYPE, self.outside)]))
+        self.assertTrue(self.extract([(".wh.esc", tarfile.REGTYPE, b"")]))
+        self.assertEqual([], os.listdir(self.root))
+        self.assert_outside_untouched()
+
+class TestUntarEngines(unittest.TestCase):
+    """The tar and python engines extract the same tree"""
+
+    layers = [
+        [("etc", tarfile.DIRTYPE, b"", 0o755), ("etc/passwd", tarfile.REGTYPE, b"root", 0o644),
+         ("etc/shadow", tarfile.REGTYPE, b"secret", 0o400), ("etc/removed", tarfile.REGTYPE, b"x", 0o644),
+         ("etc/removed.d/conf", tarfile.REGTYPE, b"conf", 0o644), ("bin", tarfile.DIRTYPE, b"", 0o555),
+         ("bin/sh", tarfile.REGTYPE, b"sh", 0o755), ("bin/bash", tarfile.LNKTYPE, "bin/sh", 0o755),
+         ("bin/ash", tarfile.SYMTYPE, "sh", 0o777), ("opt/old/a", tarfile.REGTYPE, b"a", 0o644),
+         ("opt/keep", tarfile.REGTYPE, b"k", 0o600), ("top", tarfile.REGTYPE, b"t", 0o644)],
+        [("etc/.wh.removed", tarfile.REGTYPE, b"", 0o644), ("etc/.wh.removed.d", tarfile.REGTYPE, b"", 0o644),
+         ("opt/.wh..wh..opq", tarfile.REGTYPE, b"", 0o644), ("opt/new", tarfile.REGTYPE, b"n", 0o640),
+         (".wh.top", tarfile.REGTYPE, b"", 0o644), ("etc/passwd", tarfile.REGTYPE, b"root:x", 0o600)],
+    ]
+
+    @classmethod
+    def setUpClass(cls):
+        udocker.Msg().setlevel(udocker.Msg.ERR - 1)  # quiet the expected errors
+
+    def setUp(self):
+        self.tmp_dir = os.path.realpath(tempfile.mkdtemp())
+        self.untar_engine = udocker.Config.untar_engine
+        self.tarfiles = []
+        for (index, entries) in enumerate(self.layers):
+            tarf = os.path.join(self.tmp_dir, "layer%d.tar" % index)
+            with tarfile.open(tarf, "w") as tar:
+                for (name, member_type, data, mode) in entries:
+                    info = tarfile.TarInfo(name)
+                    (info.type, info.mode, info.mtime) = (member_type, mode, 1500000000)
+                    if member_type in (tarfile.SYMTYPE, tarfile.LNKTYPE):
+                        info.linkname = data
+                    elif member_type == tarfile.REGTYPE:
+                        info.size = len(data)
+                    tar.addfile(info, io.BytesIO(data) if member_type == tarfile.REGTYPE else None)
+            self.tarfiles.append(tarf)
+
+    def tearDown(self):
+        udocker.Config.untar_engine = self.untar_engine
+        for dir_path, dummy, dummy in os.walk(self.tmp_dir):
+            os.chmod(dir_path, 0o755)
+        shutil.rmtree(self.tmp_dir)
+
+    def untar(self, engine):
+        udocker.Config.untar_engine = engine
+        destdir = os.path.join(self.tmp_dir, engine)
+        os.makedirs(destdir)
+        self.assertTrue(udocker.ContainerStructure(None)._untar_layers(self.tarfiles, destdir))
+        tree = {}
+        inodes = {}
+        for dir_path, dir_names, file_names in os.walk(destdir):
+            for name in dir_names + file_names:
+                f_path = os.path.join(dir_path, name)
+                f_stat = os.lstat(f_path)
+                entry = [f_stat.st_mode]
+                if os.path.islink(f_path):
+                    entry.append(os.readlink(f_path))
+                elif os.path.isfile(f_path):
+                    with open(f_path, "rb") as filep:
+                        entry.extend([filep.read(), int(f_stat.st_mtime)])
+                    inodes.setdefault(f_stat.st_ino, []).append(os.path.relpath(f_path, destdir))
+                tree[os.path.relpath(f_path, destdir)] = entry
+        links = sorted(sorted(names) for names in inodes.values() if len(names) > 1)
+        return (tree, links)
+
+    def test_same_tree(self):
+        (tar_tree, tar_links) = self.untar("tar")
+        (python_tree, python_links) = self.untar("python")
+        self.assertEqual(tar_tree, python_tree)
+        self.assertEqual([["bin/bash", "bin/sh"]], tar_links)
+        self.assertEqual(tar_links, python_links)
+        self.assertEqual(["bin", "bin/ash", "bin/bash", "bin/sh", "etc", "etc/passwd", "etc/shadow",
+                          "opt", "opt/new"], sorted(python_tree))
+        self.assertEqual(b"root:x", python_tree["etc/passwd"][1])
+
+class FakeFcntl(object):
+    """fcntl whose FICLONE ioctl copies the file, or fails"""
+
+    def __init__(self, supported):
+        self.supported = supported
+        self.clones = 0
+
+    def __getattr__(self, name):
+        return getattr(fcntl, name)
+
+    def ioctl(self, fd_target, request, fd_source):
+        if not self.supported or request != udocker._TreeLinker.FICLONE:
+            raise IOError("Operation not supported")
+        self.clones += 1
+        os.write(fd_target, os.read(fd_source, 1024 * 1024))
+
+class TestTreeLinker(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.source = os.path.join(self.tmp_dir, "tree")
+        os.makedirs(os.path.join(self.source, "etc"))
+        for name in ("a", "b"):
+            write_file(os.path.join(self.source, "etc", name), name.encode())
+            os.chmod(os.path.join(self.source, "etc", name), 0o444)
+        os.symlink("a", os.path.join(self.source, "etc", "link"))
+        self.fcntl = udocker.fcntl
+
+    def tearDown(self):
+        udocker.fcntl = self.fcntl
+        shutil.rmtree(self.tmp_dir)
+
+    def link(self, hardlink, reflink_supported):
+        udocker.fcntl = FakeFcntl(reflink_supported)
+        destdir = os.path.join(self.tmp_dir, "ROOT")
+        linker = udocker._TreeLinker(hardlink)
+        self.assertTrue(linker.link(self.source, destdir))
+        self.assertEqual("a", os.readlink(os.path.join(destdir, "etc", "link")))
+        return destdir
+
+    def assert_private(self, destdir):
+        for name in ("a", "b"):
+            source_stat = os.stat(os.path.join(self.source, "etc", name))
+            target_stat = os.stat(os.path.join(destdir, "etc", name))
+            self.assertNotEqual(source_stat.st_ino, target_stat.st_ino)
+            self.assertTrue(target_stat.st_mode & 0o200)
+            with open(os.path.join(destdir, "etc", name), "rb") as filep:
+                self.assertEqual(name.encode(), filep.read())
+
+    def test_reflink(self):
+        destdir = self.link(True, True)
+        self.assertEqual(2, udocker.fcntl.clones)
+        self.assert_private(destdir)
+
+    def test_hardlink_without_reflink(self):
+        destdir = self.link(True, False)
+        for name in ("a", "b"):
+            self.assertEqual(os.stat(os.path.join(self.source, "etc", name)).st_ino,
+                             os.stat(os.path.join(destdir, "etc", name)).st_ino)
+
+    def test_copy_without_reflink(self):
+        self.assert_private(self.link(False, False))
+
+    def test_copy_without_hardlink(self):
+        link = os.link
+
+        def failed_link(source, target):
+            raise OSError("Invalid cross-device link")
+        os.link = failed_link
+        try:
+            destdir = self.link(True, False)
+        finally:
+            os.link = link
+        self.assert_private(destdir)
+
+class TestLayerTrees(RepositoryTestCase):
+
+    def setUp(self):
+        RepositoryTestCase.setUp(self)
+        self.add_image("test/img", "latest", [make_layer([("etc/a", b"a"), ("etc/b", b"b")])])
+        self.config = (udocker.Config.layer_trees, udocker.Config.layer_tree_hardlinks)
+        udocker.Config.layer_trees = True
+        self.extracted = []
+        self.untar_layers = udocker.ContainerStructure._untar_layers
+
+        def counted_untar_layers(structure, tarfiles, destdir):
+            self.extracted.append(destdir)
+            return self.untar_layers(structure, tarfiles, destdir)
+        udocker.ContainerStructure._untar_layers = counted_untar_layers
+
+    def tearDown(self):
+        udocker.ContainerStructure._untar_layers = self.untar_layers
+        (udocker.Config.layer_trees, udocker.Config.layer_tree_hardlinks) = self.config
+        RepositoryTestCase.tearDown(self)
+
+    def create(self):
+        container_id = udocker.ContainerStructure(self.repo).create("test/img", "latest")
+        self.assertTrue(container_id)
+        return os.path.join(self.repo.containersdir, container_id, "ROOT")
+
+    def read(self, filename):
+        with open(filename, "rb") as filep:
+            return filep.read()
+
+    def test_tree_reused(self):
+        roots = [self.create(), self.create()]
+        # the layers are extracted once, in the tree
+        self.assertEqual(1, len(self.extracted))
+        self.assertTrue(self.extracted[0].startswith(self.repo.treesdir))
+        for root in roots:
+            self.assertEqual(b"a", self.read(os.path.join(root, "etc", "a")))
+
+    def test_container_changes_are_private(self):
+        (root1, root2) = (self.create(), self.create())
+        with open(os.path.join(root1, "etc", "a"), "ab") as filep:
+            filep.write(b" changed")
+        os.remove(os.path.join(root1, "etc", "b"))
+        self.assertEqual(b"a changed", self.read(os.path.join(root1, "etc", "a")))
+        self.assertEqual(b"a", self.read(os.path.join(root2, "etc", "a")))
+        self.assertEqual(b"b", self.read(os.path.join(root2, "etc", "b")))
+        (treedir,) = [os.path.join(self.repo.treesdir, name) for name in os.listdir(self.repo.treesdir)]
+        self.assertEqual(b"a", self.read(os.path.join(treedir, "etc", "a")))
+        self.assertEqual(b"b", self.read(os.path.join(treedir, "etc", "b")))
+
+    def test_hardlinked_files_unshared(self):
+        udocker.Config.layer_tree_hardlinks = True
+        udocker.fcntl = FakeFcntl(False)
+        try:
+            (root1, root2) = (self.create(), self.create())
+        finally:
+            udocker.fcntl = fcntl
+        filename = os.path.join(root1, "etc", "a")
+        self.assertEqual(3, os.stat(filename).st_nlink)
+        self.assertTrue(udocker.FileUtil(filename).unshare())
+        write_file(filename, b"changed")
+        self.assertEqual(b"a", self.read(os.path.join(root2, "etc", "a")))
+
+if __name__ == '__main__':
+    unittest.main()
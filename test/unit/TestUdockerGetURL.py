@@ -0,0 +1,352 @@
+import unittest
+import hashlib
+import imp
+import io
+import json
+import os
+import re
+import shutil
+import tarfile
+import tempfile
+import threading
+
+try:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+
+udocker = imp.load_source("udocker", os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                                  "..", "..", "lambda", "udocker"))
+
+def make_layer(files):
+    buf = io.BytesIO()
+    tar = tarfile.open(fileobj=buf, mode="w:gz")
+    for name, data in files:
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        tar.addfile(info, io.BytesIO(data))
+    tar.close()
+    return buf.getvalue()
+
+def blob_id(data):
+    return "sha256:" + hashlib.sha256(data).hexdigest()
+
+BLOB = os.urandom(5 * 1024 * 1024 + 123)
+BLOB_ID = blob_id(BLOB)
+TOKEN = "registry-token"
+# test/img:latest, the layers from the base one
+LAYERS = [make_layer([("etc/a", os.urandom(300 * 1024)), ("etc/b", b"b")]),
+          make_layer([("etc/.wh.b", b""), ("etc/c", b"c")]),
+          make_layer([("etc/c", b"c2"), ("etc/d", b"d")])]
+LAYER_IDS = [blob_id(data) for data in LAYERS]
+BLOBS = dict((blob_id(data), data) for data in [BLOB] + LAYERS)
+MANIFEST = {"schemaVersion": 1, "name": "test/img", "tag": "latest",
+            "fsLayers": [{"blobSum": layer_id} for layer_id in reversed(LAYER_IDS)],
+            "history": [{"v1Compatibility": json.dumps({"id": "1", "config": {"Cmd": ["sh"]}})}]}
+
+class RegistryHandler(BaseHTTPRequestHandler):
+    """Stand-in docker registry with bearer tokens, keep-alive and ranges"""
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        with self.server.lock:
+            self.server.connections += 1
+
+    def send(self, status, body=b"", headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def do_GET(self):
+        with self.server.lock:
+            headers = dict((name.lower(), value) for (name, value) in self.headers.items())
+            self.server.requests.append((self.command, self.path, headers))
+        authorized = self.headers.get("Authorization") == "Bearer " + TOKEN
+        if self.path.startswith("/token"):
+            self.send(200, json.dumps({"token": TOKEN}).encode())
+        elif self.path.startswith("/storage/"):
+            self.send_blob(self.path.rsplit("/", 1)[1])
+        elif not authorized:
+            realm = "http://%s:%d/token" % self.server.server_address
+            self.send(401, b"{}", {"WWW-Authenticate": 'Bearer realm="%s",service="registry"' % realm})
+        elif self.path == "/v2/":
+            self.send(200, b"{}")
+        elif self.path == "/v2/test/img/manifests/latest":
+            self.send(200, json.dumps(MANIFEST).encode())
+        elif "/blobs/" in self.path and self.path.rsplit("/", 1)[1] in BLOBS:
+            if self.server.redirect:
+                self.send(307, headers={"Location": "%s/storage/%s" % (self.server.redirect,
+                                                                       self.path.rsplit("/", 1)[1])})
+            else:
+                self.send_blob(self.path.rsplit("/", 1)[1])
+        else:
+            self.send(404, b"not found")
+
+    do_HEAD = do_GET
+
+    def send_blob(self, digest):
+        blob = BLOBS[digest]
+        if digest in self.server.corrupt:
+            blob = blob[:-4] + b"xxxx"
+        match = re.match(r"bytes=(\d+)-(\d*)$", self.headers.get("Range") or "")
+        if not match or not self.server.ranges:
+            self.send(200, blob, {"Accept-Ranges": "bytes"})
+            return
+        first = int(match.group(1))
+        last = min(int(match.group(2) or len(blob) - 1), len(blob) - 1)
+        if first >= len(blob):
+            self.send(416, headers={"Content-Range": "bytes */%d" % len(blob)})
+            return
+        self.send(206, blob[first:last + 1],
+                  {"Content-Range": "bytes %d-%d/%d" % (first, last, len(blob))})
+
+class RegistryServer(ThreadingMixIn, HTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self):
+        HTTPServer.__init__(self, ("127.0.0.1", 0), RegistryHandler)
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.requests = []
+        self.ranges = True
+        self.redirect = ""
+        self.corrupt = set()
+
+    def blob_requests(self, digest):
+        return [headers for (command, path, headers) in self.requests
+                if command == "GET" and path.endswith("/" + digest) and "authorization" in headers]
+
+class RegistryTestCase(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        udocker.Msg().setlevel(udocker.Msg.ERR - 1)  # quiet the expected errors
+        cls.server = RegistryServer()
+        cls.thread = threading.Thread(target=cls.server.serve_forever)
+        cls.thread.daemon = True
+        cls.thread.start()
+        cls.url = "http://127.0.0.1:%d" % cls.server.server_address[1]
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        udocker.Config.http_segment_size = 1024 * 1024
+        udocker.Config.http_segments = 4
+        udocker.GetURLhttplib._pool.clear()
+        self.server.connections = 0
+        self.server.requests = []
+        self.server.ranges = True
+        self.server.redirect = ""
+        self.server.corrupt = set()
+
+class TestGetURLhttplib(RegistryTestCase):
+
+    def setUp(self):
+        RegistryTestCase.setUp(self)
+        self.tmp_dir = tempfile.mkdtemp()
+        self.ofile = os.path.join(self.tmp_dir, BLOB_ID)
+        self.api = udocker.DockerIoAPI(None)
+        self.api.set_registry(self.url)
+
+    def tearDown(self):
+        for name in os.listdir(self.tmp_dir):
+            os.remove(os.path.join(self.tmp_dir, name))
+        os.rmdir(self.tmp_dir)
+
+    def get_blob(self, **kwargs):
+        return self.api._get_url(self.url + "/v2/test/blobs/" + BLOB_ID, ofile=self.ofile, **kwargs)
+
+    def read_ofile(self):
+        with open(self.ofile, "rb") as filep:
+            return filep.read()
+
+    def test_selected_by_default(self):
+        self.assertIsInstance(udocker.GetURL()._geturl, udocker.GetURLhttplib)
+        curl = udocker.GetURL()
+        curl.set_proxy("socks5://127.0.0.1:1080")
+        self.assertNotIsInstance(curl._geturl, udocker.GetURLhttplib)
+
+    def test_connections_reused(self):
+        self.assertTrue(self.api.is_v2())
+        (hdr, buf) = self.api._get_url(self.url + "/v2/")
+        self.assertEqual(buf.getvalue(), b"{}")
+        (hdr, dummy) = self.get_blob()
+        self.assertIn(" 200", hdr.data["X-ND-HTTPSTATUS"])
+        self.assertEqual(self.read_ofile(), BLOB)
+        # 401, token, /v2/ twice and the blob segments share the connections
+        self.assertEqual(self.server.connections, udocker.Config.http_segments)
+        self.assertGreater(len(self.server.requests), self.server.connections)
+
+    def test_segments(self):
+        (hdr, dummy) = self.get_blob()
+        self.assertEqual(hdr.data["X-ND-CURLSTATUS"], 0)
+        self.assertEqual(hdr.data["X-ND-HTTPSTATUS"], "HTTP/1.1 200 OK")
+        self.assertEqual(udocker.GetURL().get_content_length(hdr), len(BLOB))
+        self.assertEqual(self.read_ofile(), BLOB)
+        ranges = [headers.get("range") for (dummy, path, headers) in self.server.requests
+                  if "/blobs/" in path and headers.get("authorization")]
+        self.assertEqual(len(ranges), 6)
+
+    def test_server_without_ranges(self):
+        self.server.ranges = False
+        (hdr, dummy) = self.get_blob()
+        self.assertIn(" 200", hdr.data["X-ND-HTTPSTATUS"])
+        self.assertEqual(self.read_ofile(), BLOB)
+
+    def test_resume(self):
+        with open(self.ofile, "wb") as filep:
+            filep.write(BLOB[:1000])
+        (hdr, dummy) = self.get_blob(resume=True)
+        self.assertIn(" 206", hdr.data["X-ND-HTTPSTATUS"])
+        self.assertEqual(self.read_ofile(), BLOB)
+        self.assertEqual(self.server.requests[-1][2].get("range"), "bytes=1000-")
+
+    def test_resume_complete_file(self):
+        with open(self.ofile, "wb") as filep:
+            filep.write(BLOB)
+        (hdr, dummy) = self.get_blob(resume=True)
+        self.assertEqual(hdr.data["X-ND-CURLSTATUS"], 0)
+        self.assertEqual(self.read_ofile(), BLOB)
+
+    def test_redirect_drops_authorization(self):
+        self.server.redirect = "http://localhost:%d" % self.server.server_address[1]
+        (hdr, dummy) = self.get_blob()
+        self.assertEqual(hdr.data["X-ND-CURLSTATUS"], 0)
+        self.assertEqual(self.read_ofile(), BLOB)
+        storage = [headers for (dummy, path, headers) in self.server.requests
+                   if path.startswith("/storage/")]
+        self.assertTrue(storage)
+        self.assertFalse([headers for headers in storage if "authorization" in headers])
+
+    def test_size_only(self):
+        for kwargs in ({"nobody": 1}, {"sizeonly": True}):
+            (hdr, dummy) = self.api._get_url(self.url + "/v2/test/blobs/" + BLOB_ID, **kwargs)
+            self.assertEqual(udocker.GetURL().get_content_length(hdr), len(BLOB))
+
+    def test_error_removes_file(self):
+        (hdr, dummy) = self.api._get_url(self.url + "/v2/test/blobs/sha256:missing", ofile=self.ofile)
+        self.assertIn(" 404", hdr.data["X-ND-HTTPSTATUS"])
+        self.assertFalse(os.path.exists(self.ofile))
+
+    def test_error_not_written_to_stream(self):
+        ostream = udocker.StringIO()
+        (hdr, dummy) = self.api._get_url(self.url + "/v2/test/blobs/sha256:missing", ostream=ostream)
+        self.assertIn(" 404", hdr.data["X-ND-HTTPSTATUS"])
+        self.assertEqual(ostream.getvalue(), b"")
+        self.api._get_url(self.url + "/v2/")
+        self.assertEqual(self.server.connections, 1)
+
+    def test_connection_error(self):
+        (hdr, dummy) = udocker.GetURL().get("http://127.0.0.1:1/v2/")
+        self.assertTrue(hdr.data["X-ND-CURLSTATUS"])
+
+class TestPullV2(RegistryTestCase):
+
+    def setUp(self):
+        RegistryTestCase.setUp(self)
+        self.config = (udocker.Config.download_workers, udocker.Config.keep_layers)
+        udocker.Config.download_workers = 4
+        udocker.Config.keep_layers = True
+        self.top_dir = tempfile.mkdtemp()
+        self.repo = udocker.LocalRepository(self.top_dir)
+        self.repo.create_repo()
+        self.api = udocker.DockerIoAPI(self.repo)
+        self.api.set_registry(self.url)
+
+    def tearDown(self):
+        (udocker.Config.download_workers, udocker.Config.keep_layers) = self.config
+        udocker.ChkSUM().set_index(None)
+        shutil.rmtree(self.top_dir)
+
+    def layer_file(self, layer_id):
+        return os.path.join(self.repo.layersdir, layer_id)
+
+    def read_layer(self, layer_id):
+        with open(self.layer_file(layer_id), "rb") as filep:
+            return filep.read()
+
+    def has_image(self):
+        api = udocker.UdockerAPI.__new__(udocker.UdockerAPI)
+        (api.localrepo, api.udocker) = (self.repo, udocker.Udocker(self.repo))
+        return api.has_image("test/img:latest")
+
+    def create_pull(self):
+        return udocker.ContainerStructure(self.repo).create_pull(self.api, "test/img", "latest")
+
+    def read_root(self, container_id, name):
+        with open(os.path.join(self.repo.containersdir, container_id, "ROOT", name), "rb") as filep:
+            return filep.read()
+
+    def test_parallel_download(self):
+        self.assertEqual(self.api.get("test/img", "latest"), LAYER_IDS)
+        for (layer_id, data) in zip(LAYER_IDS, LAYERS):
+            self.assertEqual(self.read_layer(layer_id), data)
+            self.assertEqual(len(self.server.blob_requests(layer_id)), 1)
+        # the workers share the token obtained before they start
+        self.assertEqual(len([path for (dummy, path, dummy) in self.server.requests
+                              if path.startswith("/token")]), 1)
+        self.assertTrue(self.has_image())
+
+    def test_resume_partial_layer(self):
+        with open(self.layer_file(LAYER_IDS[0]), "wb") as filep:
+            filep.write(LAYERS[0][:1000])
+        self.assertEqual(self.api.get("test/img", "latest"), LAYER_IDS)
+        self.assertEqual(self.read_layer(LAYER_IDS[0]), LAYERS[0])
+        ranges = [headers.get("range") for headers in self.server.blob_requests(LAYER_IDS[0])]
+        self.assertEqual(ranges, ["bytes=1000-"])
+
+    def test_invalid_partial_layer_downloaded_again(self):
+        with open(self.layer_file(LAYER_IDS[0]), "wb") as filep:
+            filep.write(b"x" * 1000)
+        self.assertEqual(self.api.get("test/img", "latest"), LAYER_IDS)
+        self.assertEqual(self.read_layer(LAYER_IDS[0]), LAYERS[0])
+        self.assertEqual(len(self.server.blob_requests(LAYER_IDS[0])), 2)
+
+    def test_digest_mismatch(self):
+        self.server.corrupt.add(LAYER_IDS[1])
+        self.assertFalse(self.api.get("test/img", "latest"))
+        self.assertFalse(os.path.exists(self.layer_file(LAYER_IDS[1])))
+        self.assertFalse(self.has_image())
+
+    def test_pull_create(self):
+        container_id = self.create_pull()
+        self.assertTrue(container_id)
+        self.assertEqual(self.read_root(container_id, "etc/c"), b"c2")
+        self.assertEqual(self.read_root(container_id, "etc/d"), b"d")
+        self.assertRaises(IOError, self.read_root, container_id, "etc/b")
+        for (layer_id, data) in zip(LAYER_IDS, LAYERS):
+            self.assertEqual(self.read_layer(layer_id), data)
+            self.assertEqual(len(self.server.blob_requests(layer_id)), 1)
+        self.assertTrue(self.has_image())
+
+    def test_pull_create_without_keeping_layers(self):
+        udocker.Config.keep_layers = False
+        container_id = self.create_pull()
+        self.assertEqual(self.read_root(container_id, "etc/c"), b"c2")
+        self.assertFalse([name for name in os.listdir(self.repo.layersdir) if name.startswith("sha256:")])
+        # the image cannot create other containers, it must be pulled again
+        self.assertFalse(self.has_image())
+        self.assertTrue(self.create_pull())
+
+    def test_pull_create_digest_mismatch(self):
+        self.server.corrupt.add(LAYER_IDS[2])
+        self.assertFalse(self.create_pull())
+        self.assertEqual(os.listdir(self.repo.containersdir), [])
+
+if __name__ == '__main__':
+    unittest.main()